@@ -1,30 +1,41 @@
 import os
+import time
 import types
 
-import aniwall.version as version
 from gi.repository import GLib, Gio, Gtk
 
 from aniwall.logger import logger, debuginfo
+from aniwall.tracing import stats
 from aniwall.parser import ImageParser
 from aniwall.mainwin import MainWindow
-from aniwall.settings import SettingsWindow
-from aniwall.dialog import AboutDialog
 
 
 class Application(Gtk.Application):
 	"""Main application class"""
-	def __init__(self, is_local):
+	def __init__(self, is_local, start_time=None):
 		super().__init__(
 			application_id="com.github.worron.aniwall", flags=Gio.ApplicationFlags.HANDLES_COMMAND_LINE,
 		)
 		self.is_local = is_local
+		self.start_time = start_time if start_time is not None else time.perf_counter()
 		self.mainwin = None
+		self._setwindow = None
+		self._aboutdialog = None
+		self.show_stats = False
 		self.resource_path = "/com/github/worron/aniwall/"
 
 		self.add_main_option(
 			"log-level", 0, GLib.OptionFlags.NONE, GLib.OptionArg.STRING,
 			"Set log level", "LOG_LEVEL"
 		)
+		self.add_main_option(
+			"trace", 0, GLib.OptionFlags.NONE, GLib.OptionArg.FILENAME,
+			"Write function calls trace to file in JSON lines format", "FILE"
+		)
+		self.add_main_option(
+			"stats", 0, GLib.OptionFlags.NONE, GLib.OptionArg.NONE,
+			"Show processing stage timings over image preview and print them on exit", None
+		)
 		self.add_main_option(
 			"version", ord("v"), GLib.OptionFlags.NONE, GLib.OptionArg.NONE,
 			"Show application version", None
@@ -32,6 +43,25 @@ class Application(Gtk.Application):
 
 		self.connect("handle-local-options", self._on_handle_local_options)
 
+	# secondary windows are built on first use to speed up startup
+	@property
+	def setwindow(self):
+		if self._setwindow is None:
+			# noinspection PyPep8
+			from aniwall.settings import SettingsWindow
+
+			self._setwindow = SettingsWindow(self)
+		return self._setwindow
+
+	@property
+	def aboutdialog(self):
+		if self._aboutdialog is None:
+			# noinspection PyPep8
+			from aniwall.dialog import AboutDialog
+
+			self._aboutdialog = AboutDialog(self)
+		return self._aboutdialog
+
 	def _load_resources(self):
 		"""Initialize resources"""
 		logger.info("Loading resources...")
@@ -106,9 +136,6 @@ class Application(Gtk.Application):
 		# init application modules
 		self.parser = ImageParser(self, os.path.join(self.path["data"], "images", "test.svg"))
 		self.mainwin = MainWindow(self)
-		self.setwindow = SettingsWindow(self)
-		self.aboutdialog = AboutDialog(self)
-		self.mainwin.update_image_list()
 
 		# set application menu
 		builder = Gtk.Builder.new_from_resource(self.resource_path + "ui/menu.ui")
@@ -116,11 +143,21 @@ class Application(Gtk.Application):
 
 		logger.info("Application modules initialization complete")
 
-		# show window
+		# show window first, images are searched in background
 		logger.info("Application GUI startup")
 		self.mainwin.gui["window"].show_all()
+		self.mainwin.update_image_list()
 		self.mainwin.update_preview()
 
+		if logger.is_debug():
+			logger.debug("Main window shown in %.3f s since launch", time.perf_counter() - self.start_time)
+			# idle callback runs after first window redraw
+			GLib.idle_add(self._on_startup_finished)
+
+	def _on_startup_finished(self):
+		logger.debug("Application startup time: %.3f s", time.perf_counter() - self.start_time)
+		return False
+
 	def do_activate(self):
 		if self.mainwin is None:
 			logger.info("Start aniwall application")
@@ -140,13 +177,21 @@ class Application(Gtk.Application):
 		logger.info("Exit aniwall application")
 		if self.mainwin is not None:
 			self.mainwin.save_gui_state()
+			self.mainwin.export_queue.wait()
+		if self.show_stats:
+			print(stats.report())
 		Gtk.Application.do_shutdown(self)
 
 	# noinspection PyMethodMayBeStatic
 	def _on_handle_local_options(self, _, options):
 		"""GUI handler"""
 		if options.contains("version"):
+			# noinspection PyPep8
+			import aniwall.version as version
+
 			print(version.get_current())
+		if options.contains("stats"):
+			self.show_stats = True
 		return -1
 
 	# noinspection PyUnusedLocal
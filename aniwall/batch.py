@@ -0,0 +1,177 @@
+import os
+import argparse
+
+from lxml import etree
+from aniwall.logger import logger
+from aniwall.parser import parse_image, read_palette
+from aniwall.render import ExportPipeline
+from aniwall.storage import WriteBatch
+from aniwall.tracing import stats
+
+EXPORT_TYPES = ("png", "jpeg", "tiff", "ico", "bmp")
+NAME_TEMPLATE = "{name}_{width}x{height}"
+PALETTE_NAME_TEMPLATE = "{name}_{palette}_{width}x{height}"
+
+
+def _size(value):
+	"""Read image size from command line argument"""
+	try:
+		width, height = (int(item) for item in value.lower().split("x"))
+		if width < 1 or height < 1:
+			raise ValueError()
+	except ValueError:
+		raise argparse.ArgumentTypeError("image size should be given as WIDTHxHEIGHT, got '%s'" % value)
+	return width, height
+
+
+def _build_argument_parser():
+	"""Command line arguments description"""
+	parser = argparse.ArgumentParser(
+		prog="aniwall export", description="Export wallpapers from image patterns without GUI.",
+	)
+	parser.add_argument("patterns", nargs="+", help="SVG image patterns or directories to search them in")
+	parser.add_argument(
+		"-p", "--palette", action="append", default=[],
+		help="palette file to apply to every pattern, can be repeated to export each pattern with every palette"
+	)
+	parser.add_argument(
+		"-d", "--palette-dir", action="append", default=[], help="directory with palette files, can be repeated"
+	)
+	parser.add_argument("--palette-extension", default="plt", help="palette files extension, default is 'plt'")
+
+	transform = parser.add_argument_group("palette transform", "Applied to every palette, NumPy is required.")
+	transform.add_argument("--hue", type=float, default=0, help="rotate hue by given degrees")
+	transform.add_argument("--lightness", type=float, default=0, help="shift lightness, full range is [0, 1]")
+	transform.add_argument("--saturation", type=float, default=1, help="multiply saturation by given value")
+	transform.add_argument("--contrast", type=float, default=1, help="multiply lightness contrast by given value")
+	transform.add_argument("--invert", action="store_true", help="invert colors")
+	transform.add_argument("--match", metavar="PALETTE", help="replace colors by the nearest ones from palette file")
+	parser.add_argument(
+		"-s", "--size", type=_size, action="append", help="exported image size as WIDTHxHEIGHT, can be repeated"
+	)
+	parser.add_argument(
+		"-f", "--format", choices=EXPORT_TYPES, action="append", help="exported image type, can be repeated"
+	)
+	parser.add_argument("-o", "--output", default=os.getcwd(), help="directory to save exported images")
+	parser.add_argument(
+		"-n", "--name",
+		help="exported file name template without extension, default is '%s' or '%s' if palettes given" % (
+			NAME_TEMPLATE, PALETTE_NAME_TEMPLATE
+		)
+	)
+	parser.add_argument(
+		"-j", "--jobs", type=int, default=0, help="number of export threads, default is one per CPU core"
+	)
+	parser.add_argument(
+		"--save", action="store_true",
+		help="write palette and transform changes back to patterns, only single palette is allowed"
+	)
+	parser.add_argument(
+		"--no-sync", dest="sync", action="store_false", help="don't wait until saved patterns are written to disk"
+	)
+	parser.add_argument("--stats", action="store_true", help="print processing stage timings")
+	parser.add_argument("--log-level", help="set log level")
+	parser.add_argument("--trace", metavar="FILE", help="write function calls trace to file in JSON lines format")
+	return parser
+
+
+def find_files(paths, extension):
+	"""Expand list of files and directories to sorted list of files with given extension"""
+	files = []
+	for path in paths:
+		if os.path.isdir(path):
+			for root, _, names in os.walk(path):
+				files += [os.path.join(root, name) for name in names if name.endswith("." + extension)]
+		else:
+			files.append(path)
+	return sorted(files)
+
+
+def read_palettes(files):
+	"""Read all palette files, return list of (palette name, palette) pairs"""
+	palettes = []
+	for file_ in files:
+		try:
+			palettes.append((os.path.splitext(os.path.basename(file_))[0], read_palette(file_)))
+		except Exception:
+			logger.exception("Fail to load palette from file: %s", file_)
+	return palettes
+
+
+def run_export(argv):
+	"""Export images using command line arguments, return exit status"""
+	args = _build_argument_parser().parse_args(argv)
+	sizes = args.size or [(1920, 1080)]
+	types = args.format or ["png"]
+	os.makedirs(args.output, exist_ok=True)
+
+	palette_files = find_files(args.palette + args.palette_dir, args.palette_extension)
+	palettes = read_palettes(palette_files)
+	broken = len(palette_files) - len(palettes)
+	if not palette_files:
+		palettes = [(None, None)]
+	template = args.name or (PALETTE_NAME_TEMPLATE if palette_files else NAME_TEMPLATE)
+	if args.save and len(palettes) > 1:
+		logger.error("Only single palette can be saved to patterns")
+		return 1
+
+	transform = dict(
+		hue=args.hue, lightness=args.lightness, saturation=args.saturation,
+		contrast=args.contrast, invert=args.invert,
+	)
+	is_transformed = (
+		transform != dict(hue=0, lightness=0, saturation=1, contrast=1, invert=False) or args.match is not None
+	)
+	if is_transformed:
+		try:
+			# noinspection PyPep8
+			from aniwall.palette import transform_image
+		except ImportError:
+			logger.error("NumPy is required for palette transforms")
+			return 1
+		if args.match is not None:
+			try:
+				transform["reference"] = list(read_palette(args.match).values())
+			except Exception:
+				logger.exception("Fail to load palette from file: %s", args.match)
+				return 1
+
+	xml_parser = etree.XMLParser(remove_blank_text=True)
+	# all changed patterns are replaced together when export is done
+	with WriteBatch(args.sync) as batch, ExportPipeline(args.jobs) as pipeline:
+		for file_ in find_files(args.patterns, "svg"):
+			try:
+				with stats.measure("parse"):
+					imagedata = parse_image(file_, file_, xml_parser)
+				imagedata.validate()
+
+				# pattern is parsed once, only colors are changed for every palette
+				original_colors = imagedata.bg, list(imagedata.colors)
+				for palette_name, palette in palettes:
+					imagedata.bg, imagedata.colors = original_colors[0], list(original_colors[1])
+					if palette is not None:
+						imagedata.set_palette(palette)
+					if is_transformed:
+						transform_image(imagedata, **transform)
+					with stats.measure("serialize"):
+						imagedata.apply()
+						data = imagedata.dump()
+					if args.save:
+						imagedata.rebuild(batch=batch)
+
+					for width, height in sizes:
+						for type_ in types:
+							name = template.format(
+								name=imagedata.name, palette=palette_name, width=width, height=height
+							)
+							pipeline.submit(data, os.path.join(args.output, name + "." + type_), width, height, type_)
+			except Exception:
+				logger.exception("Broken image file:\n%s" % file_)
+				broken += 1
+
+	print(pipeline.report())
+	if args.stats:
+		print(stats.report())
+	if broken:
+		print("%d broken patterns or palettes skipped" % broken)
+	return 1 if pipeline.failed or broken else 0
@@ -1,7 +1,6 @@
 import os
 
 from gi.repository import Gtk
-import aniwall.version as version
 from aniwall.logger import logger, debuginfo
 
 
@@ -68,15 +67,19 @@ class ConfirmDialog:
 
 
 class AboutDialog:
-	"""About dialog manager"""
+	"""About dialog manager, dialog is built on first show"""
 	def __init__(self, app):
 		self._app = app
-		self._version = version.get_current()
+		self._version = None
 		self.about_dialog = None
 
-		self.rebuild()
-
 	def _build_dialog(self):
+		if self._version is None:
+			# noinspection PyPep8
+			import aniwall.version as version
+
+			self._version = version.get_current()
+
 		self.about_dialog = Gtk.AboutDialog(transient_for=self._app.mainwin.gui["window"], modal=True)
 		self.about_dialog.set_program_name("Aniwall")
 		# TODO: add application icon
@@ -105,12 +108,14 @@ class AboutDialog:
 		self.about_dialog.hide()
 
 	def rebuild(self):
+		"""Drop dialog, so it will be built again with actual artist credits on next show"""
 		if self.about_dialog is not None:
 			self.about_dialog.destroy()
-
-		self._build_dialog()
-		self._set_artists()
-		self.about_dialog.connect("response", self._on_close)
+			self.about_dialog = None
 
 	def show(self):
+		if self.about_dialog is None:
+			self._build_dialog()
+			self._set_artists()
+			self.about_dialog.connect("response", self._on_close)
 		self.about_dialog.run()
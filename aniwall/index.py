@@ -0,0 +1,108 @@
+import os
+import json
+import threading
+
+from gi.repository import GLib
+from aniwall.logger import logger
+from aniwall.storage import atomic_write
+
+
+class ImageIndex:
+	"""
+	Persistent index of image patterns.
+	Keep validation results between sessions, so unchanged files are never parsed twice.
+	Index can be changed and saved from different threads.
+	"""
+	VERSION = 2
+
+	def __init__(self, file_=None):
+		if file_ is None:
+			file_ = os.path.join(GLib.get_user_cache_dir(), "aniwall", "index.json")
+		self.file = file_
+		self.records = {}
+		self._modified = False
+		self._lock = threading.Lock()
+		self._save_lock = threading.Lock()
+
+		self.load()
+
+	@staticmethod
+	def _stamp(stat):
+		"""Build file state identifier"""
+		return [stat.st_mtime_ns, stat.st_size]
+
+	def load(self):
+		"""Read index from disk"""
+		if not os.path.isfile(self.file):
+			logger.debug("No image index found at %s", self.file)
+			return
+
+		try:
+			with open(self.file, "r") as file_:
+				data = json.load(file_)
+			if data.get("version") == self.VERSION:
+				self.records = data["records"]
+				logger.debug("Image index loaded: %d records", len(self.records))
+			else:
+				logger.debug("Image index version mismatch, index will be rebuilt")
+		except Exception:
+			logger.exception("Fail to load image index from file: %s", self.file)
+
+	def save(self):
+		"""Write index to disk if it was changed"""
+		# snapshots are written in the same order they were taken
+		with self._save_lock:
+			with self._lock:
+				if not self._modified:
+					return
+				data = json.dumps(dict(version=self.VERSION, records=self.records))
+				count = len(self.records)
+				self._modified = False
+
+			try:
+				os.makedirs(os.path.dirname(self.file), exist_ok=True)
+				atomic_write(self.file, data.encode(), sync=False)
+				logger.debug("Image index saved: %d records", count)
+			except Exception:
+				self._modified = True
+				logger.exception("Fail to save image index to file: %s", self.file)
+
+	def lookup(self, file_, stat):
+		"""Get record for file if it was not changed since last check"""
+		record = self.records.get(file_)
+		if record is not None and record["stamp"] == self._stamp(stat):
+			return record
+		return None
+
+	def update(self, file_, stat, summary):
+		"""
+		Save validation result for file.
+		Summary is a dictionary with image parameters or None for broken image.
+		"""
+		record = dict(stamp=self._stamp(stat), valid=summary is not None)
+		if summary is not None:
+			record.update(summary)
+		with self._lock:
+			self.records[file_] = record
+			self._modified = True
+		return record
+
+	def remove(self, path):
+		"""Forget file or all files in directory"""
+		with self._lock:
+			removed = [file_ for file_ in self.records if file_ == path or file_.startswith(path + os.sep)]
+			for file_ in removed:
+				del self.records[file_]
+			if removed:
+				self._modified = True
+
+	def prune(self, files):
+		"""Remove records for all files except given ones"""
+		with self._lock:
+			missed = set(self.records) - set(files)
+			for file_ in missed:
+				del self.records[file_]
+			if missed:
+				self._modified = True
+		if missed:
+			logger.debug("Removed %d outdated records from image index", len(missed))
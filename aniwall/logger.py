@@ -1,8 +1,12 @@
 import sys
 import types
+import functools
+import threading
 from itertools import chain
 import logging
 
+from aniwall.tracing import tracer, short_repr
+
 # The background is set with 40 plus the number of the color, and the foreground with 30
 CI = dict(zip(("BLACK", "RED", "GREEN", "YELLOW", "BLUE", "MAGENTA", "CYAN", "WHITE"), range(8)))
 COLORS = {'WARNING': CI["YELLOW"], 'INFO': CI["GREEN"], 'DEBUG': CI["BLUE"], 'CRITICAL': CI["RED"], 'ERROR': CI["RED"]}
@@ -20,23 +24,40 @@ MESSAGE_PATTERN = (
 
 FUNCTION_PATTERN = "$COLOR$BOLD%(levelname)s: $RESET$COLOR%(asctime)s $RESET%(message)s"
 
-_tabbing = 0
+_local = threading.local()
 _tab = ">>"
 
 
+def _colorize(pattern, level_color=""):
+	"""Substitute color tokens in pattern"""
+	for rep in [('$RESET', RESET_SEQ), ('$BOLD', BOLD_SEQ), ('$COLOR', level_color)] + COLOR_PACK:
+		pattern = pattern.replace(*rep)
+	return pattern
+
+
 class ColoredFormatter(logging.Formatter):
-	"""Colored log output formatter"""
+	"""
+	Colored log output formatter.
+	Colors are substituted to patterns once for every log level,
+	records created by debuginfo decorator use function pattern.
+	"""
+	def __init__(self, pattern, function_pattern=FUNCTION_PATTERN):
+		super().__init__(pattern)
+		self._formatters = {
+			level: (
+				logging.Formatter(_colorize(pattern, COLOR_SEQ % (30 + color))),
+				logging.Formatter(_colorize(function_pattern, COLOR_SEQ % (30 + color))),
+			)
+			for level, color in COLORS.items()
+		}
+
 	def format(self, record):
-		level_color = COLOR_SEQ % (30 + COLORS[record.levelname])
-		message = super().format(record)
-		for rep in [('$RESET', RESET_SEQ), ('$BOLD', BOLD_SEQ), ('$COLOR', level_color)] + COLOR_PACK:
-			message = message.replace(*rep)
-		return message + RESET_SEQ
+		formatter = self._formatters[record.levelname][getattr(record, "is_function", False)]
+		return formatter.format(record) + RESET_SEQ
 
 
 logger = logging.getLogger(__name__)
 color_formatter = ColoredFormatter(MESSAGE_PATTERN)
-function_formatter = ColoredFormatter(FUNCTION_PATTERN)
 
 stream_handler = logging.StreamHandler(stream=sys.stdout)
 stream_handler.setFormatter(color_formatter)
@@ -51,44 +72,92 @@ def is_debug(inst):
 logger.is_debug = types.MethodType(is_debug, logger)
 
 
+class _LazyArgs:
+	"""Function arguments formatted only if log record is emitted"""
+	def __init__(self, args, kwargs):
+		self.args = args
+		self.kwargs = kwargs
+
+	def __str__(self):
+		return ", ".join(map(short_repr, chain(self.args, self.kwargs.values())))
+
+
+class _LazyRepr:
+	"""Function result formatted only if log record is emitted"""
+	def __init__(self, value):
+		self.value = value
+
+	def __str__(self):
+		return short_repr(self.value)
+
+
+_FUNCTION_MESSAGE = _colorize("$BOLD$CYAN%s%s $RESET$CYAN%s:%s:L%s]")
+_VALUE_MESSAGE = _colorize("$BOLD$CYAN%s%s $RESET%s")
+_FINISHED_MESSAGE = _colorize("$BOLD$CYAN%s%s$RESET %s")
+_FUNCTION_EXTRA = dict(is_function=True)
+
+
 def debuginfo(input_log=True, output_log=True):
-	"""Decorator to log function details.
+	"""Decorator to log and trace function details.
+	Decision is made at decoration time, function is returned untouched if neither debug log nor tracing enabled.
 	:param input_log: show function arguments
 	:param output_log: show function result
 	:return: function wrapped for logging
 	"""
 	def real_decorator(fn):
-		if logger.getEffectiveLevel() > logging.DEBUG:
+		is_logged = logger.getEffectiveLevel() <= logging.DEBUG
+		if not is_logged and not tracer.enabled:
 			return fn
 
+		name = fn.__qualname__.split('.')[-1]
+		filename = fn.__code__.co_filename.split('/')[-1]
+		lineno = fn.__code__.co_firstlineno
+		location = "%s:L%d" % (filename, lineno)
+
+		if not is_logged:
+			@functools.wraps(fn)
+			def traced(*args, **kwargs):
+				span = tracer.begin(fn.__qualname__, location)
+				if input_log:
+					span.args = (args, kwargs)
+				try:
+					returned_value = fn(*args, **kwargs)
+					if output_log:
+						span.result = returned_value
+					return returned_value
+				finally:
+					tracer.end(span)
+
+			return traced
+
+		@functools.wraps(fn)
 		def wrapped(*args, **kwargs):
-			global _tabbing
-			name = fn.__qualname__.split('.')[-1]
-			filename = fn.__code__.co_filename.split('/')[-1]
-			lineno = fn.__code__.co_firstlineno
-			params = ", ".join(map(repr, chain(args, kwargs.values())))
-
-			# print function name
-			stream_handler.setFormatter(function_formatter)
-			logger.debug("$BOLD$CYAN%s%s $RESET$CYAN%s:%s:L%s]", _tab * _tabbing, "FUNCTION", filename, name, lineno)
+			tabbing = getattr(_local, "tabbing", 0)
+			span = tracer.begin(fn.__qualname__, location) if tracer.enabled else None
 
-			# print function arguments
+			# print function name and arguments
+			logger.debug(_FUNCTION_MESSAGE, _tab * tabbing, "FUNCTION", filename, name, lineno, extra=_FUNCTION_EXTRA)
 			if input_log:
-				logger.debug("$BOLD$CYAN%s%s $RESET%s", _tab * _tabbing, "INPUT:  ", params)
-			stream_handler.setFormatter(color_formatter)
+				logger.debug(_VALUE_MESSAGE, _tab * tabbing, "INPUT:  ", _LazyArgs(args, kwargs), extra=_FUNCTION_EXTRA)
+				if span is not None:
+					span.args = (args, kwargs)
 
 			# run original function
-			_tabbing += 1
-			returned_value = fn(*args, **kwargs)
-			_tabbing -= 1
+			_local.tabbing = tabbing + 1
+			try:
+				returned_value = fn(*args, **kwargs)
+			finally:
+				_local.tabbing = tabbing
+				if span is not None:
+					tracer.end(span)
 
 			# print function result
-			stream_handler.setFormatter(function_formatter)
 			if output_log:
-				logger.debug("$BOLD$CYAN%s%s $RESET%s", _tab * _tabbing, "OUTPUT: ", repr(returned_value))
+				logger.debug(_VALUE_MESSAGE, _tab * tabbing, "OUTPUT: ", _LazyRepr(returned_value), extra=_FUNCTION_EXTRA)
+				if span is not None:
+					span.result = returned_value
 			else:
-				logger.debug("$BOLD$CYAN%s%s$RESET %s", _tab * _tabbing, "FINISHED", name)
-			stream_handler.setFormatter(color_formatter)
+				logger.debug(_FINISHED_MESSAGE, _tab * tabbing, "FINISHED", name, extra=_FUNCTION_EXTRA)
 
 			return returned_value
 
@@ -1,8 +1,14 @@
 import os
+import queue
+import threading
 
-from gi.repository import Gtk, GdkPixbuf, Gio, Gdk
+from gi.repository import Gtk, GdkPixbuf, Gio, Gdk, GLib
 from aniwall.dialog import FileDialog, ConfirmDialog
 from aniwall.logger import logger, debuginfo
+from aniwall.watcher import LocationWatcher
+from aniwall.render import PreviewRenderer, ExportQueue, PixbufCache
+from aniwall.thumbnail import ThumbnailCache
+from aniwall.tracing import stats
 from aniwall.common import TreeViewData, GuiBase, hex_from_rgba, rgba_from_hex, pixbuf_from_hex
 
 # TODO: GUI translation (?)
@@ -10,6 +16,11 @@ from aniwall.common import TreeViewData, GuiBase, hex_from_rgba, rgba_from_hex,
 
 class MainWindow(GuiBase):
 	"""Main window constructor"""
+	PREVIEW_RESIZE_DELAY = 150
+	EXPORT_STATUS_TIMEOUT = 5
+	STATS_UPDATE_INTERVAL = 1
+	FILE_CHECK_BATCH_SIZE = 64
+
 	def __init__(self, app):
 		self._app = app
 		self._parser = app.parser
@@ -21,6 +32,8 @@ class MainWindow(GuiBase):
 			"preview", "color-box", "color-list-treeview", "color-list-selection", "image-search-entry",
 			"shift-x-spinbutton", "shift-y-spinbutton", "shift-x-spinbutton", "shift-y-spinbutton",
 			"scale-spinbutton", "color-list-scrolledwindow", "export-button", "export-as-button", "list-box",
+			"scan-box", "scan-progressbar", "scan-cancel-button", "export-box", "export-spinner", "export-label",
+			"stats-label",
 		)
 		super().__init__("mainwindow.ui", elements=elements, path=self._app.resource_path)
 
@@ -34,15 +47,56 @@ class MainWindow(GuiBase):
 		self.MIN_COLOR_COLUMN_WIDTH = int(self.COLOR_VIEW_WIDTH / 2)
 		self.IMAGE_COLUMN_WIDTH = settings_ui.get_uint("image-column-width")
 		self.PIXBUF_PATTERN_WIDTH = self.MIN_COLOR_COLUMN_WIDTH - 24
+		self.THUMBNAIL_WIDTH = settings_ui.get_uint("thumbnail-width")
+		self.THUMBNAIL_HEIGHT = settings_ui.get_uint("thumbnail-height")
 
 		self.gui["color-list-scrolledwindow"].set_property("width_request", self.COLOR_VIEW_WIDTH)
 
 		self.image_search_text = None
+		self.scan_cancel = None
+		self._index_save_source = None
+		self._preview_source = None
+		self._resize_source = None
+		self._preview_key = None
+		self._preview_pixbuf = None
+		self._preview_size = None
+
+		# background preview render, recently seen image states are kept rendered
+		self.renderer = PreviewRenderer(self._on_preview_rendered)
+		self.preview_cache = PixbufCache(settings_ui.get_uint("preview-cache-size") * 1024 * 1024)
+
+		# background export
+		self.export_queue = ExportQueue(self._on_export_progress)
+		self._export_status_source = None
+
+		# stage timings overlay
+		if self._app.show_stats:
+			self.gui["stats-label"].show()
+			self._on_stats_timeout()
+			GLib.timeout_add_seconds(self.STATS_UPDATE_INTERVAL, self._on_stats_timeout)
+
+		# image thumbnails
+		self.thumbnails = ThumbnailCache(self.THUMBNAIL_WIDTH, self.THUMBNAIL_HEIGHT, self._on_thumbnail_ready)
+		self._thumbnail_source = None
+
+		# image store rows by file, list store iters stay valid until row removed
+		self._image_rows = {}
+
+		# image locations monitor, changed files are checked in background
+		self.watcher = LocationWatcher(self._on_image_file_changed, self._on_image_files_removed)
+		self._check_queue = queue.Queue()
+		self._check_serial = 0
+		self._check_thread = threading.Thread(target=self._check_image_files, daemon=True)
+		self._check_thread.start()
 
 		# build list view
 		self.image_view_data = TreeViewData((
 			dict(literal="INDEX", title="#", type=int, visible=False),
 			dict(literal="FILE", title="File", type=str, visible=False),
+			dict(
+				literal="THUMBNAIL", title="", type=GdkPixbuf.Pixbuf,
+				render=Gtk.CellRendererPixbuf().new(), attr="pixbuf"
+			),
 			dict(literal="NAME", title="Image", type=str),
 			dict(literal="LOCATION", title="Location", type=str)
 		))
@@ -66,6 +120,10 @@ class MainWindow(GuiBase):
 			self.gui["window"], "Import color palette",
 			Gtk.FileChooserAction.OPEN, Gtk.STOCK_OPEN,
 		)
+		self.palette_extract_dialog = FileDialog(
+			self.gui["window"], "Extract color palette from image",
+			Gtk.FileChooserAction.OPEN, Gtk.STOCK_OPEN,
+		)
 
 		self.confirm_dialog = ConfirmDialog(
 			self.gui["window"],
@@ -79,7 +137,7 @@ class MainWindow(GuiBase):
 		self.clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
 
 		# actions
-		for scope, names in {"palette": ("import", "export"), "image": ("reset", "save")}.items():
+		for scope, names in {"palette": ("import", "export", "extract"), "image": ("reset", "save")}.items():
 			for name in names:
 				action = Gio.SimpleAction.new("%s-%s" % (scope, name), None)
 				action.connect("activate", getattr(self, "_on_%s_%s" % (scope, name)))
@@ -118,6 +176,7 @@ class MainWindow(GuiBase):
 		self.gui["scale-spinbutton"].connect("value-changed", self._on_scale_spinbutton_value_changed)
 		self.gui["export-button"].connect("clicked", self._on_export_button_clicked)
 		self.gui["export-as-button"].connect("clicked", self._on_export_as_button_clicked)
+		self.gui["scan-cancel-button"].connect("clicked", self._on_scan_cancel_button_clicked)
 
 	def _build_store(self):
 		"""Build GUI stores"""
@@ -128,6 +187,7 @@ class MainWindow(GuiBase):
 		)
 
 		self.image_store = self.image_view_data.build_store()
+		self.image_store.set_sort_column_id(self.image_view_data.index.FILE, Gtk.SortType.ASCENDING)
 		self.image_store_filter = self.image_store.filter_new()
 		self.image_store_filter.set_visible_func(self._image_search_filter_func)
 		self.gui["image-list-treeview"].set_model(self.image_store_filter)
@@ -135,6 +195,15 @@ class MainWindow(GuiBase):
 		self.image_column = self.gui["image-list-treeview"].get_column(self.image_view_data.index.NAME)
 		self.image_column.set_fixed_width(self.IMAGE_COLUMN_WIDTH)
 
+		# thumbnails requested only for rows in view,
+		# cell size is fixed so rows don't jump when thumbnails arrive
+		thumbnail_column = self.gui["image-list-treeview"].get_column(self.image_view_data.index.THUMBNAIL)
+		thumbnail_column.get_cells()[0].set_fixed_size(self.THUMBNAIL_WIDTH, self.THUMBNAIL_HEIGHT)
+		self.gui["image-list-treeview"].get_vadjustment().connect("value-changed", self._schedule_thumbnails_update)
+		self.gui["image-list-treeview"].connect("size-allocate", self._schedule_thumbnails_update)
+		self.image_store_filter.connect("row-inserted", self._schedule_thumbnails_update)
+		self.image_store_filter.connect("row-deleted", self._schedule_thumbnails_update)
+
 		# image colors store
 		self.color_view_data.build_columns(
 			self.gui["color-list-treeview"],
@@ -154,14 +223,131 @@ class MainWindow(GuiBase):
 
 	@debuginfo(False, False)
 	def update_image_list(self):
-		"""Set list of SVG images for GUI treeview"""
-		self._parser.load_images(*self._app.settings.get_strv("images-location-list"))
+		"""Start background search of SVG images for GUI treeview"""
+		if self.scan_cancel is not None:
+			self.scan_cancel.set()
+		self.scan_cancel = threading.Event()
+		self.watcher.stop()
+		self._check_serial += 1  # results of queued file checks are outdated now
+
 		with self.gui["image-list-selection"].handler_block(self.handler["selection"]):
 			self.image_store.clear()
-			for i, image in enumerate(self._parser.image_list):
-				path, name = os.path.split(image)
-				self.image_store.append([i, image, os.path.splitext(name)[0], path])
-		self.gui["image-list-treeview"].set_cursor(0)
+		self._image_rows = {}
+
+		self.gui["scan-progressbar"].set_fraction(0)
+		self.gui["scan-progressbar"].set_text(None)
+		self.gui["scan-box"].show()
+
+		directories = self._app.settings.get_strv("images-location-list")
+		thread = threading.Thread(target=self._scan_images, args=(directories, self.scan_cancel), daemon=True)
+		thread.start()
+
+	def _scan_images(self, directories, cancel):
+		"""Image search worker, runs in separate thread"""
+		for images, done, total in self._parser.scan_images(directories, cancel):
+			GLib.idle_add(self._on_scan_progress, cancel, images, done, total)
+		GLib.idle_add(self._on_scan_finished, cancel)
+
+	def _on_scan_progress(self, cancel, images, done, total):
+		"""Add new found images to GUI treeview"""
+		if cancel is not self.scan_cancel:
+			return False  # outdated search
+
+		with self.gui["image-list-selection"].handler_block(self.handler["selection"]):
+			for image in images:
+				self._append_image_row(image)
+
+		self.gui["scan-progressbar"].set_fraction(done / total if total else 1)
+		self.gui["scan-progressbar"].set_text("%d / %d" % (done, total))
+
+		if self.gui["image-list-selection"].count_selected_rows() == 0 and len(self.image_store_filter) > 0:
+			self.gui["image-list-treeview"].set_cursor(0)
+		return False
+
+	def _on_scan_finished(self, cancel):
+		"""Clean up after image search"""
+		if cancel is self.scan_cancel:
+			self.scan_cancel = None
+			self.gui["scan-box"].hide()
+			self.watcher.watch(*self._app.settings.get_strv("images-location-list"))
+		return False
+
+	def _append_image_row(self, file_):
+		"""Add image to GUI treeview"""
+		path, name = os.path.split(file_)
+		self._image_rows[file_] = self.image_store.append(
+			[len(self.image_store), file_, None, os.path.splitext(name)[0], path]
+		)
+
+	def _find_image_row(self, file_):
+		"""Get image store iter by file name"""
+		return self._image_rows.get(file_)
+
+	def _remove_image_row(self, file_):
+		"""Remove image from GUI treeview"""
+		treeiter = self._image_rows.pop(file_, None)
+		if treeiter is not None:
+			self.image_store.remove(treeiter)
+
+	def _schedule_index_save(self):
+		"""Save image index a bit later to handle a bunch of file events at once"""
+		if self._index_save_source is None:
+			self._index_save_source = GLib.timeout_add_seconds(2, self._on_index_save_timeout)
+
+	def _on_index_save_timeout(self):
+		"""Delayed image index save"""
+		self._index_save_source = None
+		self._parser.index.save()
+		return False
+
+	def _on_image_file_changed(self, file_):
+		"""Image location monitor handler"""
+		self._check_queue.put((self._check_serial, file_))
+
+	def _check_image_files(self):
+		"""Changed image files worker, runs in separate thread. Results are passed to main loop in batches."""
+		while True:
+			jobs = [self._check_queue.get()]
+			while len(jobs) < self.FILE_CHECK_BATCH_SIZE:
+				try:
+					jobs.append(self._check_queue.get_nowait())
+				except queue.Empty:
+					break
+
+			results = [(serial, file_, self._parser.check_file(file_)) for serial, file_ in dict.fromkeys(jobs)]
+			GLib.idle_add(self._on_image_files_checked, results)
+
+	@debuginfo(output_log=False)
+	def _on_image_files_checked(self, results):
+		"""Update images list with checked files"""
+		for serial, file_, checked in results:
+			if serial != self._check_serial:
+				continue  # image list was rebuilt since file changed
+			if checked[0] is not None and not os.path.exists(file_):
+				checked = None, None  # file was removed while it was checked
+
+			is_valid = self._parser.update_image(file_, checked)
+			treeiter = self._find_image_row(file_)
+
+			if is_valid and treeiter is None:
+				self._append_image_row(file_)
+			elif not is_valid and treeiter is not None:
+				self._remove_image_row(file_)
+			elif is_valid:
+				self.image_store[treeiter][self.image_view_data.index.THUMBNAIL] = None
+				self.thumbnails.forget(file_)
+				self._schedule_thumbnails_update()
+
+		self._schedule_index_save()
+		return False
+
+	@debuginfo()
+	def _on_image_files_removed(self, path):
+		"""Image location monitor handler"""
+		for file_ in self._parser.remove_images(path):
+			self._remove_image_row(file_)
+
+		self._schedule_index_save()
 
 	@debuginfo(False, False)
 	def update_color_list(self, set_cursor=True):
@@ -174,16 +360,48 @@ class MainWindow(GuiBase):
 		if set_cursor:
 			self.gui["color-list-treeview"].set_cursor(0)
 
+	def _get_preview_size(self):
+		"""Calculate image preview size for current GUI state"""
+		return (
+			max(self.gui["preview"].get_allocated_width() - 2 * self.IMAGE_OFFSET, 1),
+			max(self.gui["preview"].get_allocated_height() - 2 * self.IMAGE_OFFSET, 1),
+		)
+
 	def update_preview(self):
-		"""Update current image preview"""
+		"""Request current image preview update, image will be rendered in background"""
 		if self._parser.current is not None:
-			pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(
-				self._parser.temporary.name,
-				max(self.gui["preview"].get_allocated_width() - 2 * self.IMAGE_OFFSET, 1),
-				max(self.gui["preview"].get_allocated_height() - 2 * self.IMAGE_OFFSET, 1),
-				True
-			)
-			self.gui["preview"].set_from_pixbuf(pixbuf)
+			width, height = self._get_preview_size()
+			key = self._parser.preview_state + (width, height)
+			if key != self._preview_key:
+				self._preview_key = key
+				pixbuf = self.preview_cache.get(key)
+				if pixbuf is not None:
+					self.renderer.cancel()
+					self._preview_pixbuf = pixbuf
+					self.gui["preview"].set_from_pixbuf(pixbuf)
+				else:
+					self.renderer.render(self._parser.preview, width, height)
+
+	def _on_preview_rendered(self, pixbuf):
+		"""Preview renderer handler"""
+		self.preview_cache.put(self._preview_key, pixbuf)
+		self._preview_pixbuf = pixbuf
+		self.gui["preview"].set_from_pixbuf(pixbuf)
+
+	def schedule_preview_update(self):
+		"""
+		Apply image changes and update preview when main loop is idle.
+		Repeated requests are merged, so only the latest image state is rendered.
+		"""
+		if self._preview_source is None:
+			self._preview_source = GLib.idle_add(self._on_preview_idle)
+
+	def _on_preview_idle(self):
+		"""Delayed preview update"""
+		self._preview_source = None
+		self._parser.apply_changes()
+		self.update_preview()
+		return False
 
 	# noinspection PyUnusedLocal
 	@debuginfo(False, False)
@@ -195,6 +413,36 @@ class MainWindow(GuiBase):
 			logger.debug("Copy to clipboard: %s", color)
 			self.clipboard.set_text(color, -1)
 
+	# noinspection PyUnusedLocal
+	def _schedule_thumbnails_update(self, *args):
+		"""Request thumbnails for visible rows when GUI is idle, handles a bunch of scroll or store events at once"""
+		if self._thumbnail_source is None:
+			self._thumbnail_source = GLib.idle_add(self._update_visible_thumbnails)
+
+	def _update_visible_thumbnails(self):
+		"""Request missed thumbnails for image rows in view"""
+		self._thumbnail_source = None
+		self.thumbnails.clear()  # rows scrolled out of view should not wait for thumbnails
+
+		visible = self.gui["image-list-treeview"].get_visible_range()
+		if visible is not None:
+			start, end = (path.get_indices()[0] for path in visible)
+			# last request is processed first, so going from bottom to top
+			for index in range(end, start - 1, -1):
+				row = self.image_store_filter[index]
+				if row[self.image_view_data.index.THUMBNAIL] is None:
+					file_ = row[self.image_view_data.index.FILE]
+					self.thumbnails.request(file_, self._parser.get_palette_key(file_))
+		return False
+
+	def _on_thumbnail_ready(self, file_, pixbuf):
+		"""Thumbnail cache handler"""
+		self.thumbnails.forget(file_)
+		treeiter = self._find_image_row(file_)
+		if treeiter is not None:
+			self.image_store[treeiter][self.image_view_data.index.THUMBNAIL] = pixbuf
+		return False
+
 	# noinspection PyUnusedLocal
 	def _image_search_filter_func(self, model, treeiter, data):
 		"""Function to filter images list by search text"""
@@ -232,7 +480,29 @@ class MainWindow(GuiBase):
 	# noinspection PyUnusedLocal
 	def _on_image_resize(self, window, rectangle):
 		"""GUI handler"""
+		size = self._get_preview_size()
+		if size == self._preview_size:
+			return
+		self._preview_size = size
+
+		# show quickly scaled version of last render while size is changing
+		if self._preview_pixbuf is not None:
+			width, height = self._preview_pixbuf.get_width(), self._preview_pixbuf.get_height()
+			ratio = min(size[0] / width, size[1] / height)
+			self.gui["preview"].set_from_pixbuf(self._preview_pixbuf.scale_simple(
+				max(int(width * ratio), 1), max(int(height * ratio), 1), GdkPixbuf.InterpType.NEAREST
+			))
+
+		# render crisp preview when size settled
+		if self._resize_source is not None:
+			GLib.source_remove(self._resize_source)
+		self._resize_source = GLib.timeout_add(self.PREVIEW_RESIZE_DELAY, self._on_resize_settled)
+
+	def _on_resize_settled(self):
+		"""Delayed preview update after resize"""
+		self._resize_source = None
 		self.update_preview()
+		return False
 
 	# noinspection PyUnusedLocal
 	@debuginfo(False, False)
@@ -303,22 +573,58 @@ class MainWindow(GuiBase):
 		"""GUI handler"""
 		value = button.get_value()
 		self._parser.current.change_shift(value, index)
-		self._parser.apply_changes()
-		self.update_preview()
+		self.schedule_preview_update()
 
 	@debuginfo(False, False)
 	def _on_scale_spinbutton_value_changed(self, button):
 		"""GUI handler"""
 		value = "%.2f" % button.get_value()
 		self._parser.current.change_scale(value)
-		self._parser.apply_changes()
-		self.update_preview()
+		self.schedule_preview_update()
+
+	def _on_export_progress(self, done, total, failed):
+		"""Export queue handler"""
+		if self._export_status_source is not None:
+			GLib.source_remove(self._export_status_source)
+			self._export_status_source = None
+
+		if done < total:
+			self.gui["export-label"].set_text("Exporting %d / %d" % (done + 1, total))
+			self.gui["export-spinner"].start()
+			self.gui["export-box"].show()
+		elif failed:
+			self.gui["export-label"].set_text("Export failed for %d of %d images" % (failed, total))
+			self.gui["export-spinner"].stop()
+			self._export_status_source = GLib.timeout_add_seconds(
+				self.EXPORT_STATUS_TIMEOUT, self._on_export_status_timeout
+			)
+		else:
+			self.gui["export-spinner"].stop()
+			self.gui["export-box"].hide()
+
+	def _on_export_status_timeout(self):
+		"""Hide export status"""
+		self._export_status_source = None
+		self.gui["export-box"].hide()
+		return False
+
+	def _on_stats_timeout(self):
+		"""Update stage timings overlay"""
+		self.gui["stats-label"].set_text(stats.report() or "No measurements yet")
+		return True
+
+	# noinspection PyUnusedLocal
+	@debuginfo(False, False)
+	def _on_scan_cancel_button_clicked(self, *args):
+		"""GUI handler"""
+		if self.scan_cancel is not None:
+			self.scan_cancel.set()
 
 	# noinspection PyUnusedLocal
 	@debuginfo(False, False)
 	def _on_export_button_clicked(self, *args):
 		"""GUI handler"""
-		self._parser.export_image()
+		self.export_queue.add(*self._parser.prepare_export())
 
 	# noinspection PyUnusedLocal
 	@debuginfo(False, False)
@@ -332,7 +638,7 @@ class MainWindow(GuiBase):
 			name = os.path.splitext(os.path.basename(filename))[0]
 			self._app.settings.set_string("export-path", path)
 			self._parser.current.name = name
-			self._parser.export_image()
+			self.export_queue.add(*self._parser.prepare_export())
 			logger.debug("New image export settings: [path: %s], [name: %s]" % (path, name))
 		else:
 			logger.debug("Image export canceled")
@@ -352,6 +658,28 @@ class MainWindow(GuiBase):
 		else:
 			logger.debug("Palette import canceled")
 
+	# noinspection PyUnusedLocal
+	@debuginfo(False, False)
+	def _on_palette_extract(self, *args):
+		"""Action handler"""
+		is_ok, _, filename = self.palette_extract_dialog.run()
+		if is_ok:
+			logger.debug("New palette extract request: %s", filename)
+			try:
+				# noinspection PyPep8
+				from aniwall.palette import extract_palette
+
+				extract_palette(self._parser.current, filename)
+			except Exception:
+				logger.exception("Fail to extract palette from image: %s", filename)
+				return
+			self._parser.apply_changes()
+			self.update_color_list()
+			self.update_preview()
+			self._set_subtitle(True)
+		else:
+			logger.debug("Palette extract canceled")
+
 	# noinspection PyUnusedLocal
 	@debuginfo(False, False)
 	def _on_palette_export(self, *args):
@@ -361,7 +689,7 @@ class MainWindow(GuiBase):
 			if not filename.endswith(".%s" % self.palette_extension):
 				filename += ".%s" % self.palette_extension
 			logger.debug("New palette export settings: %s" % filename)
-			self._parser.current.export_colors(filename)
+			self._parser.current.export_colors(filename, self._app.settings.get_boolean("sync-writes"))
 		else:
 			logger.debug("Palette export canceled")
 
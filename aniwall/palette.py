@@ -0,0 +1,149 @@
+"""
+Bulk palette operations.
+Colors are converted to OKLab perceptual color space and transformed as a single array.
+"""
+import numpy as np
+
+from gi.repository import GdkPixbuf
+
+# reference image is downscaled on load and sampled to keep color extraction fast for any image size
+EXTRACT_IMAGE_SIZE = 512
+EXTRACT_SAMPLES = 20000
+EXTRACT_ITERATIONS = 12
+
+_LMS_FROM_RGB = np.array([
+	[0.4122214708, 0.5363325363, 0.0514459929],
+	[0.2119034982, 0.6806995451, 0.1073969566],
+	[0.0883024619, 0.2817188376, 0.6299787005],
+])
+_LAB_FROM_LMS = np.array([
+	[0.2104542553, 0.7936177850, -0.0040720468],
+	[1.9779984951, -2.4285922050, 0.4505937099],
+	[0.0259040371, 0.7827717662, -0.8086757660],
+])
+_RGB_FROM_LMS = np.linalg.inv(_LMS_FROM_RGB)
+_LMS_FROM_LAB = np.linalg.inv(_LAB_FROM_LMS)
+
+
+def rgb_from_hex(colors):
+	"""Convert list of html hex colors to array of sRGB values in range [0, 1]"""
+	values = []
+	for color in colors:
+		hex_ = color.strip().lstrip("#")
+		if len(hex_) == 3:
+			hex_ = "".join(c * 2 for c in hex_)
+		values.append(int(hex_, 16))
+	values = np.array(values, dtype=np.uint32)
+	return np.stack([(values >> 16) & 0xff, (values >> 8) & 0xff, values & 0xff], axis=-1) / 255
+
+
+def hex_from_rgb(rgb):
+	"""Convert array of sRGB values in range [0, 1] to list of html hex colors"""
+	values = np.rint(np.clip(rgb, 0, 1) * 255).astype(np.uint32)
+	return ["#%06X" % value for value in (values[:, 0] << 16) | (values[:, 1] << 8) | values[:, 2]]
+
+
+def oklab_from_rgb(rgb):
+	"""Convert sRGB array to OKLab"""
+	linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+	return np.cbrt(linear @ _LMS_FROM_RGB.T) @ _LAB_FROM_LMS.T
+
+
+def rgb_from_oklab(lab):
+	"""Convert OKLab array to sRGB, values are clipped to sRGB gamut"""
+	linear = np.clip(((lab @ _LMS_FROM_LAB.T) ** 3) @ _RGB_FROM_LMS.T, 0, 1)
+	return np.where(linear <= 0.0031308, linear * 12.92, 1.055 * linear ** (1 / 2.4) - 0.055)
+
+
+def nearest_colors(lab, reference):
+	"""Replace every color by perceptually closest one from reference OKLab array"""
+	distance = ((lab[:, np.newaxis, :] - reference[np.newaxis, :, :]) ** 2).sum(axis=-1)
+	return reference[distance.argmin(axis=1)]
+
+
+def transform_colors(colors, hue=0, lightness=0, saturation=1, contrast=1, invert=False, reference=None):
+	"""
+	Transform list of html hex colors at once.
+	:param hue: hue rotation in degrees
+	:param lightness: lightness shift, OKLab lightness range is [0, 1]
+	:param saturation: chroma multiplier
+	:param contrast: lightness contrast multiplier around middle gray
+	:param invert: invert colors
+	:param reference: list of html hex colors, every color will be mapped to the nearest one of them
+	:return: list of transformed colors
+	"""
+	rgb = rgb_from_hex(colors)
+	if invert:
+		rgb = 1 - rgb
+	lab = oklab_from_rgb(rgb)
+
+	angle = np.radians(hue)
+	rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+	lab[:, 1:] = (lab[:, 1:] @ rotation.T) * saturation
+	lab[:, 0] = np.clip((lab[:, 0] - 0.5) * contrast + 0.5 + lightness, 0, 1)
+
+	if reference:
+		lab = nearest_colors(lab, oklab_from_rgb(rgb_from_hex(reference)))
+
+	return hex_from_rgb(rgb_from_oklab(lab))
+
+
+def transform_image(imagedata, **kwargs):
+	"""Transform background and all colors of image, see transform_colors for arguments"""
+	colors = transform_colors([imagedata.bg] + imagedata.colors, **kwargs)
+	imagedata.bg, imagedata.colors = colors[0], colors[1:]
+
+
+def load_image_colors(file_):
+	"""
+	Load raster image as array of sRGB values, image is downscaled while decoding.
+	Fully transparent pixels are skipped, their color is usually meaningless black.
+	"""
+	pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(file_, EXTRACT_IMAGE_SIZE, EXTRACT_IMAGE_SIZE, True)
+	width, height, channels = pixbuf.get_width(), pixbuf.get_height(), pixbuf.get_n_channels()
+	pixels = np.frombuffer(pixbuf.get_pixels(), dtype=np.uint8)
+	# rows may be padded, last row may be shorter than row stride
+	pixels = np.pad(pixels, (0, height * pixbuf.get_rowstride() - pixels.size)).reshape(height, -1)
+	pixels = pixels[:, :width * channels].reshape(-1, channels)
+	if channels == 4:
+		pixels = pixels[pixels[:, 3] > 0]
+	if not len(pixels):
+		raise Exception("No visible pixels in image")
+	return pixels[:, :3] / 255
+
+
+def extract_colors(rgb, count, seed=0):
+	"""
+	Find dominant colors with k-means clustering in OKLab color space.
+	:param rgb: array of sRGB values
+	:param count: number of colors
+	:return: list of html hex colors sorted by lightness
+	"""
+	rng = np.random.default_rng(seed)
+	if len(rgb) > EXTRACT_SAMPLES:
+		rgb = rgb[rng.choice(len(rgb), EXTRACT_SAMPLES, replace=False)]
+	lab = oklab_from_rgb(rgb)
+
+	# k-means++ initialization
+	centers = [lab[rng.integers(len(lab))]]
+	for _ in range(count - 1):
+		distance = ((lab[:, np.newaxis, :] - np.array(centers)[np.newaxis, :, :]) ** 2).sum(axis=-1).min(axis=1)
+		total = distance.sum()
+		centers.append(lab[rng.choice(len(lab), p=distance / total)] if total > 0 else lab[rng.integers(len(lab))])
+	centers = np.array(centers)
+
+	for _ in range(EXTRACT_ITERATIONS):
+		labels = ((lab[:, np.newaxis, :] - centers[np.newaxis, :, :]) ** 2).sum(axis=-1).argmin(axis=1)
+		sums = np.zeros_like(centers)
+		np.add.at(sums, labels, lab)
+		sizes = np.bincount(labels, minlength=count)[:, np.newaxis]
+		centers = np.where(sizes > 0, sums / np.maximum(sizes, 1), centers)
+
+	centers = centers[centers[:, 0].argsort()]
+	return hex_from_rgb(rgb_from_oklab(centers))
+
+
+def extract_palette(imagedata, file_):
+	"""Set image background and colors from dominant colors of raster image, darker colors go first"""
+	colors = extract_colors(load_image_colors(file_), len(imagedata.colors) + 1)
+	imagedata.bg, imagedata.colors = colors[0], colors[1:]
@@ -1,13 +1,19 @@
+import io
 import os
 import re
-import tempfile
-import shutil
+import sys
+import time
+import bisect
+import threading
 
 from configparser import ConfigParser
 from itertools import count
 from lxml import etree
-from gi.repository import GdkPixbuf
 from aniwall.logger import logger, debuginfo
+from aniwall.index import ImageIndex
+from aniwall.storage import WriteBatch, atomic_write, is_writable
+from aniwall.tracing import stats
+from aniwall.render import export_svg
 
 
 class ImageData:
@@ -24,10 +30,14 @@ class ImageData:
 		self.shift = [0, 0]
 		self.scale = "1.00"
 
+		# original document and positions of customizable attribute values in it
+		self.source = None
+		self.spans = None
+
 	def __repr__(self):
 		return "<%s> %s" % (
 			self.__module__ + "." + self.__class__.__name__,
-			str({k: v for k, v in self.__dict__.items() if k not in ("tags", "tree")})
+			str({k: v for k, v in self.__dict__.items() if k not in ("tags", "tree", "source", "spans")})
 		)
 
 	@debuginfo(input_log=False)
@@ -57,6 +67,25 @@ class ImageData:
 		self.scale = scale.group(1)
 		self.tags["transform"] = tag
 
+	def set_tags(self, tags):
+		"""Save all image properties from dictionary of tags by id"""
+		self.set_transform(tags["transform"])
+		self.set_background(tags["background"])
+		for index in count(1):
+			id_ = "color" + str(index)
+			if id_ not in tags:
+				break
+			self.set_color(tags[id_], id_)
+
+	def validate(self):
+		"""Check if all customizable tag parameters were found"""
+		if (
+			self.bg is None
+			or any([item is None for item in self.colors])
+			or any([item is None for item in self.shift])
+		):
+			raise Exception("Missed tag parameter")
+
 	def change_color(self, color, index):
 		"""Change color in palette by index"""
 		if index == 0:
@@ -76,31 +105,73 @@ class ImageData:
 		"""Swap colors by index"""
 		self.colors[i1], self.colors[i2] = self.colors[i2], self.colors[i1]
 
-	def rebuild(self, file_=None):
-		"""Apply image changes"""
-		if file_ is None:
-			file_ = self.file
-
-		if not os.access(file_, os.W_OK):
-			logger.warning("Permission denied to change %s", file_)
-			return
-
+	def apply(self):
+		"""Update SVG tags with current image parameters"""
 		transform_data = (self.shift[0], self.shift[1], self.scale)
 		self.tags["transform"].set("transform", "translate(%s,%s) scale(%s)" % transform_data)
 		self.tags["background"].set("fill", self.bg)
 		for i, color in enumerate(self.colors, start=1):
 			self.tags["color" + str(i)].set("fill", color)
 
-		self.tree.write(file_, pretty_print=True)
-
-		if logger.is_debug:
+		if logger.is_debug():
 			tag_info = "Current image parameters "
 			for name, tag in self.tags.items():
-				attr = "transform" if name == "transform" else "fill"
-				tag_info += "[%s: %s], " % (name, tag.get(attr))
+				tag_info += "[%s: %s], " % (name, tag.get(_tag_attribute(name)))
 			logger.debug(tag_info)
 
-	def export_colors(self, file_):
+	def dump(self):
+		"""Serialize SVG document to bytes"""
+		return etree.tostring(self.tree)
+
+	def set_source(self, source):
+		"""
+		Save original document and find customizable attributes in it.
+		If some attribute can't be found, changes will be saved by full document serialization.
+		"""
+		self.source = source
+		self.spans = find_attribute_spans(source, {id_: _tag_attribute(id_) for id_ in self.tags})
+		if self.spans is None:
+			logger.debug("Attributes patching is not available for %s", self.file)
+
+	def patch(self):
+		"""Write current attribute values directly to original document, so its formatting is preserved"""
+		pieces, last, shift = [], 0, 0
+		spans = {}
+		for id_, (start, end, quote) in sorted(self.spans.items(), key=lambda item: item[1][0]):
+			value = self.tags[id_].get(_tag_attribute(id_))
+			value = value.replace("&", "&amp;").replace("<", "&lt;").replace(quote, "&#%d;" % ord(quote))
+			value = value.encode()
+			pieces += [self.source[last:start], value]
+			spans[id_] = (start + shift, start + shift + len(value), quote)
+			shift += len(value) - (end - start)
+			last = end
+		pieces.append(self.source[last:])
+
+		self.source = b"".join(pieces)
+		self.spans = spans
+		return self.source
+
+	def rebuild(self, file_=None, batch=None):
+		"""
+		Apply image changes and write them to file.
+		File is replaced atomically, several files can be saved together with write batch.
+		"""
+		if file_ is None:
+			file_ = self.file
+
+		if not is_writable(file_):
+			logger.warning("Permission denied to change %s", file_)
+			return
+
+		with stats.measure("serialize"):
+			self.apply()
+			data = self.patch() if self.spans is not None else etree.tostring(self.tree, pretty_print=True)
+		if batch is not None:
+			batch.write(file_, data)
+		else:
+			atomic_write(file_, data)
+
+	def export_colors(self, file_, sync=True):
 		"""Export colors to ini file"""
 		bg = dict(background=self.bg)
 		colors = {"color" + str(i): c for i, c in enumerate(self.colors)}
@@ -109,124 +180,418 @@ class ImageData:
 
 		config = ConfigParser()
 		config["colors"] = palette
-		with open(file_, "w") as configfile:
-			config.write(configfile)
+		text = io.StringIO()
+		config.write(text)
+		atomic_write(file_, text.getvalue().encode(), sync)
+
+	def set_palette(self, palette):
+		"""Set colors from palette dictionary"""
+		self.bg = palette["background"]
+		for i, color in enumerate(self.colors):
+			tag = "color" + str(i)
+			if tag in palette:
+				self.colors[i] = palette[tag]
+		logger.debug("Updated color scheme: %s, %s", self.bg, str(self.colors))
 
 	def import_colors(self, file_):
 		"""Import colors from ini file"""
 		try:
-			config = ConfigParser()
-			config.read(file_)
-			self.bg = config["colors"]["background"]
-			for i, color in enumerate(self.colors):
-				tag = "color" + str(i)
-				if tag in config["colors"]:
-					self.colors[i] = config["colors"][tag]
-			logger.debug("Updated color scheme: %s, %s", self.bg, str(self.colors))
+			self.set_palette(read_palette(file_))
 		except Exception:
 			logger.exception("Fail to load palette from file: %s", file_)
 
 
+def read_palette(file_):
+	"""Read palette dictionary from ini file"""
+	config = ConfigParser()
+	if not config.read(file_):
+		raise Exception("Can't read palette file")
+	if not config.has_option("colors", "background"):
+		raise Exception("Missed background color in palette file")
+	return dict(config["colors"])
+
+
+class TagCollector:
+	"""
+	Lxml parser target to find image tags in a single pass without building a tree.
+	Collect attributes of background, transform and colorN elements from SVG namespace.
+	"""
+	def __init__(self):
+		self.namespace = None
+		self.tags = {}
+
+	def start(self, tag, attrib):
+		if self.namespace is None:
+			if not tag.startswith("{"):
+				raise Exception("Missed SVG namespace")
+			self.namespace = tag[:tag.index("}") + 1]
+
+		id_ = attrib.get("id")
+		if id_ is not None and id_ not in self.tags and tag.startswith(self.namespace) and is_image_tag(id_):
+			self.tags[id_] = dict(attrib)
+
+	def end(self, tag):
+		pass
+
+	def data(self, data):
+		pass
+
+	def close(self):
+		return self.tags
+
+
+def is_image_tag(id_):
+	"""Check if element id is one of image customizable tags"""
+	return id_ in ("background", "transform") or (id_.startswith("color") and id_[5:].isdigit())
+
+
+def _tag_attribute(id_):
+	"""Get name of customizable attribute for image tag"""
+	return "transform" if id_ == "transform" else "fill"
+
+
+_MARKUP_RE = re.compile(
+	rb"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<[?!].*?>"
+	rb"|<[^\s/>]+((?:\s+[^\s=/>]+\s*=\s*(?:\"[^\"]*\"|'[^']*'))*)\s*/?>",
+	re.DOTALL
+)
+_ATTRIBUTE_RE = re.compile(rb"([^\s=/>]+)\s*=\s*(?:\"([^\"]*)\"|'([^']*)')")
+
+
+def find_attribute_spans(source, attributes):
+	"""
+	Find positions of attribute values in raw XML document.
+	:param source: document bytes
+	:param attributes: dictionary of element id and attribute name pairs
+	:return: dictionary of element id and (start, end, quote) tuples or None if some attribute not found
+	"""
+	if source.startswith((b"\xff\xfe", b"\xfe\xff")):
+		return None  # only ascii compatible encodings can be patched
+
+	spans = {}
+	for markup in _MARKUP_RE.finditer(source):
+		if markup.group(1) is None:
+			continue  # comment, declaration or instruction
+		values = {}
+		for attribute in _ATTRIBUTE_RE.finditer(markup.group(1)):
+			group = 2 if attribute.group(2) is not None else 3
+			offset = markup.start(1)
+			values[attribute.group(1)] = (
+				offset + attribute.start(group), offset + attribute.end(group), "\"" if group == 2 else "'"
+			)
+
+		id_ = values.get(b"id")
+		if id_ is not None:
+			id_ = source[id_[0]:id_[1]].decode()
+			if id_ in attributes and id_ not in spans:
+				span = values.get(attributes[id_].encode())
+				if span is None:
+					return None
+				spans[id_] = span
+
+	return spans if len(spans) == len(attributes) else None
+
+
+def parse_image(file_, source, parser):
+	"""Read image settings from SVG tags"""
+	with open(source, "rb") as source_file:
+		raw = source_file.read()
+	tree = etree.ElementTree(etree.fromstring(raw, parser))
+	root = tree.getroot()
+	# namespace may be set as default or with prefix, the same way as in TagCollector
+	namespace = etree.QName(root).namespace
+	if namespace is None:
+		raise Exception("Missed SVG namespace")
+	xhtml = "{%s}" % namespace
+
+	imagedata = ImageData(file_, tree)
+
+	# build id index in one traversal
+	tags = {}
+	for element in root.iterdescendants(xhtml + "*"):
+		id_ = element.get("id")
+		if id_ is not None and id_ not in tags and is_image_tag(id_):
+			tags[id_] = element
+
+	imagedata.set_tags(tags)
+	imagedata.set_source(raw)
+	return imagedata
+
+
+def check_image(file_):
+	"""
+	Validate image and return its parameters, None will be returned for broken image.
+	Tags are extracted by streaming parser, so no tree is built.
+	Defined on module level to be usable in worker processes.
+	"""
+	try:
+		temp_data = ImageData(None, None)
+		temp_data.set_tags(etree.parse(file_, etree.XMLParser(target=TagCollector())))
+		temp_data.validate()
+		return dict(bg=temp_data.bg, colors=temp_data.colors, shift=temp_data.shift, scale=temp_data.scale)
+	except Exception:
+		logger.exception("Broken image file:\n%s" % file_)
+		return None
+
+
+def check_images(files):
+	"""Validate list of images, used as a single job for worker process"""
+	return [check_image(file_) for file_ in files]
+
+
 class ImageParser:
 	"""
 	Image manager.
 	Read and edit SVG images.
 	"""
-	def __init__(self, app, image_sample):
+	PARALLEL_SCAN_LIMIT = 32
+	SCAN_POLL_INTERVAL = 0.2
+
+	def __init__(self, app, image_sample, index=None):
 		self._app = app
 		self._testimage = image_sample
-		self.temporary = tempfile.NamedTemporaryFile()
 		self.parser = etree.XMLParser(remove_blank_text=True)
 		self.current = None
+		self.preview = None
+		self.preview_state = None
+		self._current_stamp = None
 		self.image_list = []
+		self.index = index if index is not None else ImageIndex()
+		self._scan_lock = threading.Lock()
 
 	def _load_image_data(self, file_, source):
 		"""Read image settings from SVG tags"""
-		tree = etree.parse(source, self.parser)
-		root = tree.getroot()
-		xhtml = "{%s}" % root.nsmap[None]
-
-		imagedata = ImageData(file_, tree)
-
-		transform_tag = root.find(".//%s*[@id='transform']" % xhtml)
-		imagedata.set_transform(transform_tag)
-
-		background_tag = root.find(".//%s*[@id='background']" % xhtml)
-		imagedata.set_background(background_tag)
-
-		counter = count(1)
-		while True:
-			index = next(counter)
-			id_ = "color" + str(index)
-			tag = root.find(".//%s*[@id='%s']" % (xhtml, id_))
-			if tag is None:
-				break
-			imagedata.set_color(tag, id_)
+		with stats.measure("parse"):
+			return parse_image(file_, source, self.parser)
+
+	def _get_scan_workers(self):
+		"""Number of processes used to check images"""
+		workers = self._app.settings.get_uint("scan-workers")
+		return workers if workers > 0 else os.cpu_count() or 1
+
+	def _check_images(self, files, cancel=None):
+		"""
+		Validate list of images, use process pool for big lists. Results are yielded in files order.
+		If worker process crashes, rest of images are checked in current process.
+		"""
+		workers = min(self._get_scan_workers(), len(files))
+		# process pool can't use forkserver before python 3.7, forking process with running GUI threads isn't safe
+		if workers < 2 or len(files) < self.PARALLEL_SCAN_LIMIT or sys.version_info < (3, 7):
+			yield from map(check_image, files)
+			return
 
-		return imagedata
+		# noinspection PyPep8
+		import multiprocessing
+		# noinspection PyPep8
+		from concurrent.futures import ProcessPoolExecutor, TimeoutError
+		# noinspection PyPep8
+		from concurrent.futures.process import BrokenProcessPool
+
+		logger.debug("Checking %d images with %d processes", len(files), workers)
+		size = max(1, len(files) // (workers * 4))
+		chunks = [files[i:i + size] for i in range(0, len(files), size)]
+		executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("forkserver"))
+		jobs = []
+		try:
+			jobs += [executor.submit(check_images, chunk) for chunk in chunks]
+			for i, job in enumerate(jobs):
+				while True:
+					try:
+						results = job.result(timeout=self.SCAN_POLL_INTERVAL)
+						break
+					except TimeoutError:
+						if cancel is not None and cancel.is_set():
+							return
+					except BrokenProcessPool:
+						logger.error("Image check process terminated abruptly, continue in main process")
+						for file_ in (file_ for chunk in chunks[i:] for file_ in chunk):
+							yield check_image(file_)
+						return
+				yield from results
+		finally:
+			# pending checks are dropped if search was stopped
+			for job in jobs:
+				job.cancel()
+			executor.shutdown(wait=False)
+
+	def scan_images(self, directories, cancel=None, batch_size=64):
+		"""
+		Find all formatted SVG images in directories.
+		Generator, yields tuple (list of new found images, number of processed files, total number of files).
+		Search can be stopped by setting cancel event.
+		"""
+		with self._scan_lock:
+			start = time.perf_counter()
+			svg_files = []
+			for path in directories:
+				for root, _, files in os.walk(path):
+					svg_files += [os.path.join(root, name) for name in files if name.endswith('.svg')]
+
+			# use index for unchanged files
+			file_stats = {}
+			for file_ in svg_files:
+				try:
+					file_stats[file_] = os.stat(file_)
+				except OSError:
+					logger.exception("Can't read image file:\n%s" % file_)
+
+			imagepack = []
+			outdated = []
+			for file_, stat in file_stats.items():
+				record = self.index.lookup(file_, stat)
+				if record is None:
+					outdated.append(file_)
+				elif record["valid"]:
+					imagepack.append(file_)
+
+			total = len(file_stats)
+			done = total - len(outdated)
+			yield list(imagepack), done, total
+
+			# check if images formatted correctly
+			batch = []
+			for file_, summary in zip(outdated, self._check_images(outdated, cancel)):
+				record = self.index.update(file_, file_stats[file_], summary)
+				done += 1
+				if record["valid"]:
+					batch.append(file_)
+				if len(batch) >= batch_size or (cancel is not None and cancel.is_set()):
+					imagepack += batch
+					yield batch, done, total
+					batch = []
+				if cancel is not None and cancel.is_set():
+					logger.debug("Image search canceled")
+					break
+			else:
+				self.index.prune(svg_files)
+			self.index.save()
+
+			imagepack += batch
+			logger.debug("%s image files was found, %s of them was checked." % (len(imagepack), len(outdated)))
+			if not imagepack and not (cancel is not None and cancel.is_set()):
+				logger.warning("No image was found.\nLoad test sample.")
+				batch.append(self._testimage)
+				imagepack.append(self._testimage)
+
+			self.image_list = sorted(imagepack)
+			stats.add("scan", time.perf_counter() - start)
+			if batch:
+				yield batch, done, total
 
 	@debuginfo(output_log=False)
 	def load_images(self, *directories):
 		"""Find all formatted SVG images in directories"""
-		imagepack = []
-		for path in directories:
-			for root, _, files in os.walk(path):
-				svg_files = [os.path.join(root, name) for name in files if name.endswith('.svg')]
-				# check if images formatted correctly
-				for file_ in svg_files:
-					try:
-						temp_data = self._load_image_data(None, file_)
-						if (
-							temp_data.bg is None
-							or any([item is None for item in temp_data.colors])
-							or any([item is None for item in temp_data.shift])
-						):
-							raise Exception("Missed tag parameter")
-						imagepack.append(file_)
-					except Exception:
-						logger.exception("Broken image file:\n%s" % file_)
-
-		logger.debug("%s image files was found." % len(imagepack))
-		if not imagepack:
-			logger.warning("No image was found.\nLoad test sample.")
-			imagepack.append(self._testimage)
-
-		self.image_list = sorted(imagepack)
+		for _ in self.scan_images(directories):
+			pass
+
+	def check_file(self, file_):
+		"""
+		Validate single image file without changing parser state, safe to use from worker thread.
+		Return tuple (file stat, image summary), stat is None for missing file and summary is None for broken one.
+		"""
+		try:
+			stat = os.stat(file_)
+		except OSError:
+			return None, None
+
+		record = self.index.lookup(file_, stat)
+		if record is None:
+			return stat, check_image(file_)
+		elif record["valid"]:
+			return stat, dict(bg=record["bg"], colors=record["colors"], shift=record["shift"], scale=record["scale"])
+		else:
+			return stat, None
+
+	@debuginfo()
+	def update_image(self, file_, checked=None):
+		"""
+		Check single image file and update images list. Return True if image is valid.
+		Result of check_file can be given to skip file validation.
+		"""
+		stat, summary = checked if checked is not None else self.check_file(file_)
+		if stat is None:
+			self.remove_images(file_)
+			return False
+
+		record = self.index.lookup(file_, stat)
+		if record is None:
+			record = self.index.update(file_, stat, summary)
+
+		position = bisect.bisect_left(self.image_list, file_)
+		is_listed = position < len(self.image_list) and self.image_list[position] == file_
+		if record["valid"] and not is_listed:
+			self.image_list.insert(position, file_)
+		elif not record["valid"] and is_listed:
+			del self.image_list[position]
+
+		return record["valid"]
+
+	@debuginfo()
+	def remove_images(self, path):
+		"""Forget image file or all images in directory. Return list of removed images."""
+		removed = [file_ for file_ in self.image_list if file_ == path or file_.startswith(path + os.sep)]
+		for file_ in removed:
+			self.image_list.remove(file_)
+		self.index.remove(path)
+		return removed
+
+	def get_palette_key(self, file_):
+		"""Get text description of image colors from index"""
+		record = self.index.records.get(file_, {})
+		return " ".join([record.get("bg") or ""] + record.get("colors", []))
 
 	@debuginfo()
 	def load_image_data(self, file_, source):
 		"""Read image settings from SVG tags"""
 		return self._load_image_data(file_, source)
 
+	def _update_preview(self):
+		"""Serialize current image for preview and describe its state"""
+		self.preview = self.current.dump()
+		# geometry values are strings when read from file and numbers after GUI changes
+		self.preview_state = (
+			self.current.file, self._current_stamp, self.current.bg, tuple(self.current.colors),
+			tuple(float(value) for value in self.current.shift), float(self.current.scale),
+		)
+
 	@debuginfo(output_log=False)
 	def set_image(self, file_):
 		"""Select currently active image"""
-		shutil.copy2(file_, self.temporary.name)  # create temporary copy
-		self.current = self.load_image_data(file_, self.temporary.name)  # parse SVG data
+		self.current = self.load_image_data(file_, file_)  # parse SVG data
+		self._current_stamp = os.stat(file_).st_mtime_ns
+		self._update_preview()
 
 	@debuginfo(False, False)
 	def apply_changes(self):
 		"""Preview image changes"""
-		self.current.rebuild(self.temporary.name)
+		with stats.measure("serialize"):
+			self.current.apply()
+			self._update_preview()
 
 	@debuginfo(False, False)
 	def save_changes(self):
 		"""Save image changes"""
-		self.current.rebuild()
+		with WriteBatch(self._app.settings.get_boolean("sync-writes")) as batch:
+			self.current.rebuild(batch=batch)
 
 	@debuginfo(False, False)
 	def reset_changes(self):
 		"""Reset image changes"""
 		self.set_image(self.current.file)
 
-	@debuginfo(False, False)
-	def export_image(self):
-		"""GUI handler"""
+	@debuginfo(output_log=False)
+	def prepare_export(self):
+		"""Get current image export parameters: SVG document, file name, width, height and image type"""
 		type_ = self._app.settings.get_string("export-type")
 		file_ = os.path.join(self._app.settings.get_string("export-path"), self.current.name + "." + type_)
 		width = self._app.settings.get_string("export-width")
 		height = self._app.settings.get_string("export-height")
 		logger.debug("Exporting image: %s at size %sx%s", file_, width, height)
 
-		pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(self.temporary.name, int(width), int(height), False)
-		pixbuf.savev(file_, type_, [], [])
+		self.current.apply()
+		return self.current.dump(), file_, int(width), int(height), type_
+
+	@debuginfo(False, False)
+	def export_image(self):
+		"""Export current image with application settings"""
+		export_svg(*self.prepare_export())
@@ -0,0 +1,292 @@
+import os
+import re
+import time
+import queue
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
+from gi.repository import GLib, Gio, GdkPixbuf
+from aniwall.logger import logger
+from aniwall.tracing import stats
+from aniwall.writer import WRITERS
+from aniwall.storage import replacing
+
+# exports bigger than this number of pixels are rendered by horizontal bands if image type allows it
+TILED_EXPORT_LIMIT = 32 * 1024 * 1024
+TILE_PIXELS = 4 * 1024 * 1024
+
+
+def pixbuf_from_svg(data, width, height, preserve_aspect=True, cancellable=None):
+	"""Rasterize SVG document from memory"""
+	stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(data))
+	return GdkPixbuf.Pixbuf.new_from_stream_at_scale(stream, width, height, preserve_aspect, cancellable)
+
+
+def _get_viewbox(root):
+	"""Read SVG document view box, build it from document size if missed. None is returned if size is unknown."""
+	if root.get("viewBox") is not None:
+		return [float(value) for value in re.split(r"[\s,]+", root.get("viewBox").strip())]
+	size = [re.match(r"[\d.]+", root.get(name, "")) for name in ("width", "height")]
+	if not all(size):
+		return None
+	return [0, 0] + [float(match.group()) for match in size]
+
+
+def export_tiled(data, file_, width, height, type_):
+	"""
+	Rasterize SVG document by horizontal bands and write them with streaming image writer.
+	Peak memory usage depends on the band size, not on the full image size.
+	Return False if document size is unknown, so it can't be split.
+	"""
+	root = etree.fromstring(data)
+	viewbox = _get_viewbox(root)
+	if viewbox is None:
+		logger.debug("No view box or size found in %s, tiled export is not possible", file_)
+		return False
+
+	x, y, view_width, view_height = viewbox
+	band_height = max(TILE_PIXELS // width, 1)
+	logger.debug("Tiled export of %s by %d rows bands", file_, band_height)
+
+	root.set("width", str(width))
+	root.set("preserveAspectRatio", "none")
+	writer = None
+	try:
+		for top in range(0, height, band_height):
+			rows = min(band_height, height - top)
+			root.set("height", str(rows))
+			root.set(
+				"viewBox", "%s %s %s %s" % (x, y + top * view_height / height, view_width, rows * view_height / height)
+			)
+			pixbuf = pixbuf_from_svg(etree.tostring(root), width, rows, preserve_aspect=False)
+
+			if writer is None:
+				writer = WRITERS[type_](file_, width, height, pixbuf.get_has_alpha())
+			pixels, stride = pixbuf.get_pixels(), pixbuf.get_rowstride()
+			row_size = width * pixbuf.get_n_channels()
+			writer.write_rows([pixels[i * stride:i * stride + row_size] for i in range(rows)])
+	finally:
+		if writer is not None:
+			writer.close()
+	return True
+
+
+def export_svg(data, file_, width, height, type_):
+	"""
+	Rasterize SVG document from memory and save it to image file.
+	Image is written to temporary file first, so interrupted export never leaves truncated image.
+	"""
+	with stats.measure("export"), replacing(file_) as temp_file:
+		is_tiled = type_ in WRITERS and width * height > TILED_EXPORT_LIMIT
+		if not (is_tiled and export_tiled(data, temp_file, width, height, type_)):
+			pixbuf = pixbuf_from_svg(data, width, height, preserve_aspect=False)
+			pixbuf.savev(temp_file, type_, [], [])
+
+
+def _export_job(data, file_, width, height, type_):
+	"""Export SVG document, log result and return True on success"""
+	try:
+		export_svg(data, file_, width, height, type_)
+		logger.info("Image exported: %s", file_)
+		return True
+	except Exception:
+		logger.exception("Fail to export image: %s", file_)
+		return False
+
+
+class PreviewRenderer:
+	"""
+	Rasterize SVG documents in background thread.
+	Only the latest request is rendered, pending request is replaced by newer one.
+	Render in progress can't be interrupted, its result is dropped if newer request came in meanwhile.
+	Result is passed to callback in main loop.
+	"""
+	def __init__(self, callback):
+		self._callback = callback
+		self._condition = threading.Condition()
+		self._request = None
+		self._serial = 0
+
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def render(self, data, width, height):
+		"""Request new render"""
+		with self._condition:
+			self._serial += 1
+			self._request = (self._serial, data, width, height)
+			self._condition.notify()
+
+	def cancel(self):
+		"""Drop pending request and result of render in progress"""
+		with self._condition:
+			self._serial += 1
+			self._request = None
+
+	def _run(self):
+		"""Render worker, runs in separate thread"""
+		while True:
+			with self._condition:
+				while self._request is None:
+					self._condition.wait()
+				serial, data, width, height = self._request
+				self._request = None
+
+			try:
+				start = time.perf_counter()
+				pixbuf = pixbuf_from_svg(data, width, height)
+				stats.add("rasterize", time.perf_counter() - start)
+			except GLib.Error:
+				logger.exception("Fail to render image preview")
+				continue
+
+			GLib.idle_add(self._deliver, serial, pixbuf)
+
+	def _deliver(self, serial, pixbuf):
+		"""Pass rendered image to callback if it is still actual"""
+		if serial == self._serial:
+			self._callback(pixbuf)
+		return False
+
+
+class PixbufCache:
+	"""
+	LRU cache of rendered images limited by total pixel data size.
+	Should be used from main loop only.
+	"""
+	def __init__(self, budget):
+		self.budget = budget
+		self.size = 0
+		self._items = OrderedDict()
+
+	def get(self, key):
+		"""Find image, None will be returned if image is not cached"""
+		pixbuf = self._items.get(key)
+		if pixbuf is not None:
+			self._items.move_to_end(key)
+		return pixbuf
+
+	def put(self, key, pixbuf):
+		"""Save image, least recently used images are dropped to fit memory budget"""
+		size = pixbuf.get_byte_length()
+		if size > self.budget:
+			return
+
+		if key in self._items:
+			self.size -= self._items.pop(key).get_byte_length()
+		self._items[key] = pixbuf
+		self.size += size
+
+		while self.size > self.budget:
+			_, dropped = self._items.popitem(last=False)
+			self.size -= dropped.get_byte_length()
+
+	def clear(self):
+		"""Drop all images"""
+		self._items.clear()
+		self.size = 0
+
+
+class ExportPipeline:
+	"""
+	Export images in parallel with thread pool.
+	Every pattern should be serialized once, the same document is shared by all its export targets.
+	Number of pending exports is limited, so documents don't pile up in memory when export is slower than parsing.
+	Use as context manager, all submitted exports are finished on exit.
+	"""
+	PENDING_PER_WORKER = 2
+
+	def __init__(self, workers=None):
+		self.workers = workers or os.cpu_count() or 1
+		self.exported = 0
+		self.failed = 0
+		self.pixels = 0
+		self.elapsed = 0
+		self._executor = None
+		self._slots = None
+		self._lock = threading.Lock()
+		self._start = None
+
+	def __enter__(self):
+		self._executor = ThreadPoolExecutor(max_workers=self.workers)
+		self._slots = threading.BoundedSemaphore(self.workers * self.PENDING_PER_WORKER)
+		self._start = time.perf_counter()
+		return self
+
+	def __exit__(self, *args):
+		self._executor.shutdown(wait=True)
+		self.elapsed = time.perf_counter() - self._start
+
+	def submit(self, data, file_, width, height, type_):
+		"""Add SVG document export to queue, blocks while too many exports are pending"""
+		self._slots.acquire()
+		self.pixels += width * height
+		self._executor.submit(_export_job, data, file_, width, height, type_).add_done_callback(self._on_job_done)
+
+	def _on_job_done(self, future):
+		"""Count finished export, runs in worker thread"""
+		with self._lock:
+			if future.result():
+				self.exported += 1
+			else:
+				self.failed += 1
+		self._slots.release()
+
+	def report(self):
+		"""Text summary of finished exports"""
+		elapsed = max(self.elapsed, 1e-6)
+		return "%d images exported, %d failed in %.2f s with %d threads (%.1f images/s, %.1f Mpx/s)" % (
+			self.exported, self.failed, self.elapsed, self.workers,
+			(self.exported + self.failed) / elapsed, self.pixels / elapsed / 1e6
+		)
+
+
+class ExportQueue:
+	"""
+	Background export queue.
+	Exports are processed one by one in separate thread, progress is passed to callback in main loop.
+	Callback receives number of finished exports, total number of exports and number of failed ones,
+	counters are reset when queue is empty.
+	"""
+	def __init__(self, callback):
+		self._callback = callback
+		self._queue = queue.Queue()
+		self.total = 0
+		self.done = 0
+		self.failed = 0
+
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def add(self, data, file_, width, height, type_):
+		"""Add SVG document export to queue"""
+		self.total += 1
+		self._queue.put((data, file_, width, height, type_))
+		self._callback(self.done, self.total, self.failed)
+
+	def wait(self):
+		"""Block until all queued exports are finished"""
+		if self._queue.unfinished_tasks:
+			logger.info("Waiting for %d image exports to finish", self._queue.unfinished_tasks)
+		self._queue.join()
+
+	def _run(self):
+		"""Export worker, runs in separate thread"""
+		while True:
+			job = self._queue.get()
+			is_ok = _export_job(*job)
+			self._queue.task_done()
+			GLib.idle_add(self._on_job_done, is_ok)
+
+	def _on_job_done(self, is_ok):
+		"""Update queue state in main loop"""
+		self.done += 1
+		if not is_ok:
+			self.failed += 1
+		self._callback(self.done, self.total, self.failed)
+
+		if self.done == self.total:
+			self.total, self.done, self.failed = 0, 0, 0
+		return False
@@ -1,13 +1,16 @@
 #!/usr/bin/python3
 
-import re
 import os
 import sys
 import gi
+import time
 import signal
 
+_start_time = time.perf_counter()
+
 # check gi version
 gi.require_version('Gtk', '3.0')
+gi.require_version('GdkPixbuf', '2.0')
 
 # set module for local run
 is_local = __name__ == "__main__"
@@ -22,20 +25,46 @@ def set_log_level(args):
 	# noinspection PyPep8
 	from aniwall.logger import logger
 
-	level = re.search("log-level=(\w+)", str(args))
+	level = None
+	for i, arg in enumerate(args):
+		if arg.startswith("--log-level="):
+			level = arg.split("=", 1)[1]
+		elif arg == "--log-level" and i + 1 < len(args):
+			level = args[i + 1]
+
 	try:
-		logger.setLevel(level.group(1))
+		logger.setLevel(level)
 	except Exception:
 		logger.setLevel("WARNING")
 
 
+def set_trace(args):
+	# noinspection PyPep8
+	from aniwall.tracing import tracer
+
+	for i, arg in enumerate(args):
+		if arg.startswith("--trace="):
+			tracer.enable(arg.split("=", 1)[1])
+		elif arg == "--trace" and i + 1 < len(args):
+			tracer.enable(args[i + 1])
+
+
 def run():
+	# both should be set before any other module import, so debuginfo decorators know what to do
 	set_log_level(sys.argv)
+	set_trace(sys.argv)
+
+	# headless mode
+	if len(sys.argv) > 1 and sys.argv[1] == "export":
+		# noinspection PyPep8
+		from aniwall.batch import run_export
+
+		sys.exit(run_export(sys.argv[2:]))
 
 	# noinspection PyPep8
 	from aniwall.application import Application
 
-	app = Application(is_local)
+	app = Application(is_local, _start_time)
 	exit_status = app.run(sys.argv)
 	sys.exit(exit_status)
 
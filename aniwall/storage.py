@@ -0,0 +1,127 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+# mode for new files, temporary files are created with private permissions
+_umask = os.umask(0)
+os.umask(_umask)
+_NEW_FILE_MODE = 0o666 & ~_umask
+
+
+def is_writable(file_):
+	"""Check if file can be replaced, its directory should be writable as well as the file itself"""
+	file_ = os.path.realpath(file_)
+	is_file_writable = not os.path.exists(file_) or os.access(file_, os.W_OK)
+	return is_file_writable and os.access(os.path.dirname(file_), os.W_OK | os.X_OK)
+
+
+def _create_temp(file_):
+	"""
+	Create temporary file next to target with target permissions, return file descriptor and name.
+	Target should be a real path, otherwise symbolic link will be replaced instead of file.
+	"""
+	directory, name = os.path.split(file_)
+	fd, temp_file = tempfile.mkstemp(dir=directory, prefix="." + name + ".", suffix=".part")
+	try:
+		os.chmod(temp_file, os.stat(file_).st_mode & 0o7777 if os.path.exists(file_) else _NEW_FILE_MODE)
+	except Exception:
+		os.close(fd)
+		os.unlink(temp_file)
+		raise
+	return fd, temp_file
+
+
+def _sync_directory(path):
+	"""Flush directory entries to disk"""
+	fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+class WriteBatch:
+	"""
+	Atomic file writes.
+	Every file is written to temporary file next to target and renamed over it on commit,
+	so interrupted write never leaves broken file.
+	With sync enabled every file is flushed to disk before renaming and every touched directory is synced once per batch.
+	Symbolic links are kept, files they point to are replaced.
+	Use as context manager, files are committed on successful exit and discarded on error.
+	"""
+	def __init__(self, sync=True):
+		self.sync = sync
+		self._files = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, *args):
+		if exc_type is None:
+			self.commit()
+		else:
+			self.discard()
+
+	def write(self, file_, data):
+		"""Write bytes to temporary copy of file"""
+		file_ = os.path.realpath(file_)
+		fd, temp_file = _create_temp(file_)
+		try:
+			with os.fdopen(fd, "wb") as output:
+				output.write(data)
+				if self.sync:
+					output.flush()
+					os.fsync(output.fileno())
+		except Exception:
+			os.unlink(temp_file)
+			raise
+		self._files.append((temp_file, file_))
+
+	def commit(self):
+		"""Replace target files with written data, files left uncommitted on error are discarded"""
+		directories = set()
+		try:
+			for i, (temp_file, file_) in enumerate(self._files):
+				os.replace(temp_file, file_)
+				directories.add(os.path.dirname(file_))
+		except Exception:
+			del self._files[:i]
+			self.discard()
+			raise
+		finally:
+			if self.sync:
+				for directory in directories:
+					_sync_directory(directory)
+		self._files = []
+
+	def discard(self):
+		"""Remove all temporary files"""
+		for temp_file, _ in self._files:
+			try:
+				os.unlink(temp_file)
+			except OSError:
+				pass
+		self._files = []
+
+
+def atomic_write(file_, data, sync=True):
+	"""Replace file content atomically"""
+	with WriteBatch(sync) as batch:
+		batch.write(file_, data)
+
+
+@contextmanager
+def replacing(file_):
+	"""
+	Context manager for writers which need file name.
+	Gives temporary file name, the file replaces target on successful exit and removed on error.
+	"""
+	file_ = os.path.realpath(file_)
+	fd, temp_file = _create_temp(file_)
+	os.close(fd)
+	try:
+		yield temp_file
+		os.replace(temp_file, file_)
+	except BaseException:
+		os.unlink(temp_file)
+		raise
@@ -0,0 +1,113 @@
+import os
+import time
+import hashlib
+import threading
+
+from gi.repository import GLib, GdkPixbuf
+from aniwall.logger import logger
+
+
+class ThumbnailCache:
+	"""
+	Persistent image thumbnails storage.
+	Thumbnails are rendered on request in background thread and saved to user cache directory.
+	Result is passed to callback in main loop.
+	Thumbnails which were not used for a while are removed on start,
+	so outdated ones left after image changes don't pile up.
+	"""
+	MAX_AGE = 30 * 24 * 60 * 60
+
+	def __init__(self, width, height, callback, directory=None):
+		if directory is None:
+			directory = os.path.join(GLib.get_user_cache_dir(), "aniwall", "thumbnails")
+		self.directory = directory
+		self.width = width
+		self.height = height
+		self._callback = callback
+		self._condition = threading.Condition()
+		self._pending = []
+		self._requested = set()
+
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def request(self, file_, palette):
+		"""
+		Request thumbnail for image.
+		Palette is a text description of image colors, it is used as a part of cache key.
+		"""
+		with self._condition:
+			if file_ not in self._requested:
+				self._requested.add(file_)
+				self._pending.append((file_, palette))
+				self._condition.notify()
+
+	def forget(self, file_):
+		"""Allow new request for image, should be used when image changed"""
+		with self._condition:
+			self._requested.discard(file_)
+
+	def clear(self):
+		"""Drop all requests which are not processed yet"""
+		with self._condition:
+			for file_, _ in self._pending:
+				self._requested.discard(file_)
+			self._pending = []
+
+	def _get_cache_file(self, file_, palette):
+		"""Build cache file name for image in current state"""
+		stat = os.stat(file_)
+		key = "%s:%d:%d:%dx%d:%s" % (file_, stat.st_mtime_ns, stat.st_size, self.width, self.height, palette)
+		return os.path.join(self.directory, hashlib.md5(key.encode()).hexdigest() + ".png")
+
+	def _load(self, file_, palette):
+		"""Read thumbnail from cache or render new one"""
+		cache_file = self._get_cache_file(file_, palette)
+		if os.path.isfile(cache_file):
+			try:
+				pixbuf = GdkPixbuf.Pixbuf.new_from_file(cache_file)
+				os.utime(cache_file)  # mark thumbnail as recently used
+				return pixbuf
+			except GLib.Error:
+				logger.warning("Broken thumbnail for %s will be rebuilt", file_)
+
+		pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(file_, self.width, self.height, True)
+		os.makedirs(self.directory, exist_ok=True)
+		temp_file = cache_file + ".part"
+		pixbuf.savev(temp_file, "png", [], [])
+		os.replace(temp_file, cache_file)
+		return pixbuf
+
+	def prune(self):
+		"""Remove thumbnails which were not used longer than max age"""
+		if not os.path.isdir(self.directory):
+			return
+
+		removed = 0
+		deadline = time.time() - self.MAX_AGE
+		for entry in os.scandir(self.directory):
+			try:
+				if entry.name.endswith(".part") or entry.stat().st_mtime < deadline:
+					os.unlink(entry.path)
+					removed += 1
+			except OSError:
+				logger.exception("Fail to remove outdated thumbnail: %s", entry.path)
+		logger.debug("Removed %d outdated thumbnails", removed)
+
+	def _run(self):
+		"""Thumbnail worker, runs in separate thread"""
+		self.prune()
+		while True:
+			with self._condition:
+				while not self._pending:
+					self._condition.wait()
+				# latest requests first, they are most likely visible now
+				file_, palette = self._pending.pop()
+
+			try:
+				pixbuf = self._load(file_, palette)
+			except Exception:
+				logger.exception("Fail to build thumbnail for %s", file_)
+				continue
+
+			GLib.idle_add(self._callback, file_, pixbuf)
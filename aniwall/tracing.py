@@ -0,0 +1,157 @@
+import json
+import time
+import atexit
+import reprlib
+import threading
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+
+# arguments are never fully printed, big objects like image data or xml trees are shortened
+_repr = reprlib.Repr()
+_repr.maxstring = 80
+_repr.maxother = 80
+
+
+def short_repr(value):
+	"""Bounded object representation"""
+	return _repr.repr(value)
+
+
+class Span:
+	"""Single function call record, arguments are formatted only when record is read"""
+	__slots__ = ("name", "location", "thread", "depth", "start", "duration", "args", "result")
+
+	def __init__(self, name, location, thread, depth, start):
+		self.name = name
+		self.location = location
+		self.thread = thread
+		self.depth = depth
+		self.start = start
+		self.duration = None
+		self.args = None
+		self.result = None
+
+	def as_dict(self):
+		"""Span description ready for serialization"""
+		record = dict(
+			name=self.name, location=self.location, thread=self.thread, depth=self.depth,
+			start=self.start, duration=self.duration,
+		)
+		if self.args is not None:
+			record["args"] = [short_repr(arg) for arg in self.args[0]]
+			record["kwargs"] = {key: short_repr(value) for key, value in self.args[1].items()}
+		if self.result is not None:
+			record["result"] = short_repr(self.result)
+		return record
+
+
+class Tracer:
+	"""
+	Function call tracer.
+	Finished spans are kept in ring buffer and optionally written to JSON lines file.
+	File is written in blocks, so traced call costs only a couple of clock reads.
+	Spans keep references to arguments and results until they are written or dropped from buffer.
+	"""
+	FLUSH_SIZE = 256
+
+	def __init__(self):
+		self.enabled = False
+		self.file = None
+		self.spans = deque(maxlen=1024)
+		self._pending = []
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+	def enable(self, file_=None, buffer_size=1024):
+		"""Start tracing, should be called before traced modules are imported"""
+		self.enabled = True
+		self.file = file_
+		self.spans = deque(maxlen=buffer_size)
+		if file_ is not None:
+			open(file_, "w").close()
+		atexit.register(self.flush)
+
+	def begin(self, name, location):
+		"""Open new span for current thread"""
+		depth = getattr(self._local, "depth", 0)
+		self._local.depth = depth + 1
+		return Span(name, location, threading.get_ident(), depth, time.perf_counter())
+
+	def end(self, span):
+		"""Close span and store it"""
+		span.duration = time.perf_counter() - span.start
+		self._local.depth = span.depth
+		self.spans.append(span)
+
+		if self.file is not None:
+			with self._lock:
+				self._pending.append(span)
+				is_full = len(self._pending) >= self.FLUSH_SIZE
+			if is_full:
+				self.flush()
+
+	def flush(self):
+		"""Write pending spans to trace file"""
+		with self._lock:
+			pending, self._pending = self._pending, []
+		if pending and self.file is not None:
+			lines = "".join(json.dumps(span.as_dict()) + "\n" for span in pending)
+			with open(self.file, "a") as trace_file:
+				trace_file.write(lines)
+			for span in pending:
+				span.args = span.result = None
+
+	def records(self):
+		"""List of last finished spans as dictionaries"""
+		return [span.as_dict() for span in list(self.spans)]
+
+
+class StageStats:
+	"""
+	Durations of main processing stages.
+	Last measurements of every stage are kept to calculate median and 95th percentile.
+	"""
+	HISTORY_SIZE = 1000
+
+	def __init__(self):
+		self._stages = OrderedDict()
+		self._counts = {}
+		self._lock = threading.Lock()
+
+	def add(self, stage, duration):
+		"""Save stage duration in seconds"""
+		with self._lock:
+			if stage not in self._stages:
+				self._stages[stage] = deque(maxlen=self.HISTORY_SIZE)
+				self._counts[stage] = 0
+			self._stages[stage].append(duration)
+			self._counts[stage] += 1
+
+	@contextmanager
+	def measure(self, stage):
+		"""Context manager to measure stage duration"""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(stage, time.perf_counter() - start)
+
+	def summary(self):
+		"""Dictionary of stage name: (number of measurements, median, 95th percentile)"""
+		with self._lock:
+			stages = [(stage, sorted(durations), self._counts[stage]) for stage, durations in self._stages.items()]
+		return OrderedDict(
+			(stage, (count, durations[len(durations) // 2], durations[min(len(durations) * 95 // 100, len(durations) - 1)]))
+			for stage, durations, count in stages
+		)
+
+	def report(self):
+		"""Text summary of stage durations"""
+		return "\n".join(
+			"%-10s %6d  p50 %8.1f ms  p95 %8.1f ms" % (stage, count, p50 * 1000, p95 * 1000)
+			for stage, (count, p50, p95) in self.summary().items()
+		)
+
+
+tracer = Tracer()
+stats = StageStats()
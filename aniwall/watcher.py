@@ -0,0 +1,83 @@
+import os
+
+from gi.repository import Gio, GLib
+from aniwall.logger import logger
+
+
+class LocationWatcher:
+	"""
+	Image locations monitor.
+	Watch directories trees and report changed or removed SVG files.
+	"""
+	def __init__(self, on_changed, on_removed):
+		self._on_changed = on_changed
+		self._on_removed = on_removed
+		self.monitors = {}
+
+	def watch(self, *directories):
+		"""Start monitoring of given directories and all their subdirectories"""
+		self.stop()
+		for path in directories:
+			for root, _, _ in os.walk(path):
+				self._add_monitor(root)
+		logger.debug("Watching %d image directories", len(self.monitors))
+
+	def stop(self):
+		"""Stop all monitors"""
+		for monitor in self.monitors.values():
+			monitor.cancel()
+		self.monitors = {}
+
+	def _add_monitor(self, path):
+		"""Start single directory monitor"""
+		if path in self.monitors:
+			return
+		try:
+			monitor = Gio.File.new_for_path(path).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+		except GLib.Error:
+			logger.exception("Fail to watch image directory: %s", path)
+			return
+		monitor.connect("changed", self._on_monitor_changed)
+		self.monitors[path] = monitor
+
+	def _remove_monitors(self, path):
+		"""Stop monitors for directory and all its subdirectories"""
+		for monitored in [item for item in self.monitors if item == path or item.startswith(path + os.sep)]:
+			self.monitors.pop(monitored).cancel()
+
+	def _add_path(self, path):
+		"""Handle new file or directory"""
+		if os.path.isdir(path):
+			for root, _, files in os.walk(path):
+				self._add_monitor(root)
+				for name in files:
+					if name.endswith(".svg"):
+						self._on_changed(os.path.join(root, name))
+		elif path.endswith(".svg"):
+			self._on_changed(path)
+
+	def _remove_path(self, path):
+		"""Handle removed file or directory"""
+		self._remove_monitors(path)
+		self._on_removed(path)
+
+	# noinspection PyUnusedLocal
+	def _on_monitor_changed(self, monitor, file_, other_file, event):
+		"""Directory monitor handler"""
+		path = file_.get_path()
+		logger.debug("Image location event %s: %s", event.value_nick, path)
+
+		if event == Gio.FileMonitorEvent.CHANGES_DONE_HINT:
+			if path.endswith(".svg"):
+				self._on_changed(path)
+		elif event == Gio.FileMonitorEvent.CREATED:
+			# new files will be checked on CHANGES_DONE_HINT event, only directories handled here
+			if os.path.isdir(path):
+				self._add_path(path)
+		elif event == Gio.FileMonitorEvent.MOVED_IN:
+			self._add_path(path)
+		elif event in (Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.MOVED_OUT):
+			self._remove_path(path)
+		elif event == Gio.FileMonitorEvent.RENAMED:
+			self._remove_path(path)
+			self._add_path(other_file.get_path())
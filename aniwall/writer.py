@@ -0,0 +1,119 @@
+import zlib
+import struct
+
+
+class PngWriter:
+	"""
+	Streaming PNG encoder.
+	Image rows are compressed and written to file as soon as they are received.
+	"""
+	CHUNK_SIZE = 1 << 16
+
+	def __init__(self, file_, width, height, has_alpha):
+		self.width = width
+		self.height = height
+		self.channels = 4 if has_alpha else 3
+		self._file = open(file_, "wb")
+		self._compressor = zlib.compressobj(6)
+		self._buffer = b""
+
+		self._file.write(b"\x89PNG\r\n\x1a\n")
+		color_type = 6 if has_alpha else 2
+		self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+
+	def _write_chunk(self, type_, data):
+		"""Write PNG chunk with checksum"""
+		self._file.write(struct.pack(">I", len(data)) + type_ + data)
+		self._file.write(struct.pack(">I", zlib.crc32(type_ + data) & 0xffffffff))
+
+	def write_rows(self, rows):
+		"""Add list of image rows, each row is a bytes object of packed pixels"""
+		self._buffer += self._compressor.compress(b"".join(b"\x00" + row for row in rows))
+		if len(self._buffer) >= self.CHUNK_SIZE:
+			self._write_chunk(b"IDAT", self._buffer)
+			self._buffer = b""
+
+	def close(self):
+		"""Finish image, file is closed even if it can't be finished"""
+		try:
+			self._write_chunk(b"IDAT", self._buffer + self._compressor.flush())
+			self._write_chunk(b"IEND", b"")
+		finally:
+			self._file.close()
+
+
+class TiffWriter:
+	"""
+	Streaming TIFF encoder.
+	Writes uncompressed baseline TIFF, every received band of rows is stored as a separate strip.
+	All bands except the last one should have the same height.
+	"""
+	SHORT = 3
+	LONG = 4
+
+	def __init__(self, file_, width, height, has_alpha):
+		self.width = width
+		self.height = height
+		self.channels = 4 if has_alpha else 3
+		self._file = open(file_, "wb")
+		self._strips = []
+		self._rows_per_strip = None
+
+		# header, IFD offset will be set on close
+		self._file.write(b"II*\x00" + struct.pack("<I", 0))
+
+	def write_rows(self, rows):
+		"""Add list of image rows, each row is a bytes object of packed pixels"""
+		if self._rows_per_strip is None:
+			self._rows_per_strip = len(rows)
+		data = b"".join(rows)
+		self._strips.append((self._file.tell(), len(data)))
+		self._file.write(data)
+
+	def _write_value(self, type_, values):
+		"""Pack tag values, values which don't fit in directory entry are written to file and offset returned"""
+		data = struct.pack("<%d%s" % (len(values), "H" if type_ == self.SHORT else "I"), *values)
+		if len(data) <= 4:
+			return data.ljust(4, b"\x00")
+
+		if self._file.tell() % 2:
+			self._file.write(b"\x00")
+		offset = self._file.tell()
+		self._file.write(data)
+		return struct.pack("<I", offset)
+
+	def close(self):
+		"""Write image file directory and finish image, file is closed even if it can't be finished"""
+		try:
+			tags = [
+				(256, self.LONG, [self.width]),
+				(257, self.LONG, [self.height]),
+				(258, self.SHORT, [8] * self.channels),
+				(259, self.SHORT, [1]),  # no compression
+				(262, self.SHORT, [2]),  # RGB
+				(273, self.LONG, [offset for offset, _ in self._strips]),
+				(277, self.SHORT, [self.channels]),
+				(278, self.LONG, [self._rows_per_strip or self.height]),
+				(279, self.LONG, [count for _, count in self._strips]),
+				(284, self.SHORT, [1]),  # chunky planar configuration
+			]
+			if self.channels == 4:
+				tags.append((338, self.SHORT, [2]))  # unassociated alpha
+
+			entries = [
+				struct.pack("<HHI", tag, type_, len(values)) + self._write_value(type_, values)
+				for tag, type_, values in tags
+			]
+
+			if self._file.tell() % 2:
+				self._file.write(b"\x00")
+			ifd_offset = self._file.tell()
+			self._file.write(struct.pack("<H", len(entries)) + b"".join(entries) + struct.pack("<I", 0))
+
+			self._file.seek(4)
+			self._file.write(struct.pack("<I", ifd_offset))
+		finally:
+			self._file.close()
+
+
+WRITERS = dict(png=PngWriter, tiff=TiffWriter)
@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+
+"""
+Aniwall performance benchmarks.
+
+Synthetic image patterns are generated in temporary directory, so results are reproducible
+and can be compared between commits. No display is needed.
+
+Run:
+$ python3 benchmarks/benchmark.py --output results.json
+Compare with previous results:
+$ python3 benchmarks/benchmark.py --compare results.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+
+LOCAL_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(LOCAL_DIR, ".."))
+
+# noinspection PyPep8
+from aniwall.parser import ImageParser
+# noinspection PyPep8
+from aniwall.index import ImageIndex
+# noinspection PyPep8
+from aniwall.storage import WriteBatch
+# noinspection PyPep8
+from aniwall.render import pixbuf_from_svg
+# noinspection PyPep8
+from aniwall.batch import _size
+
+PATTERN_WIDTH = 1920
+PATTERN_HEIGHT = 1080
+
+
+class BenchmarkSettings:
+	"""Fixed application settings, benchmarks don't touch user configuration"""
+	def __init__(self, **values):
+		self.values = dict(values)
+
+	def get_uint(self, key):
+		return self.values[key]
+
+	def get_boolean(self, key):
+		return self.values[key]
+
+	def get_string(self, key):
+		return str(self.values[key])
+
+
+class BenchmarkApp:
+	"""Minimal application structure required by image parser"""
+	def __init__(self, export_path):
+		self.settings = BenchmarkSettings(**{
+			"scan-workers": 0, "sync-writes": False, "export-path": export_path,
+			"export-type": "png", "export-width": PATTERN_WIDTH, "export-height": PATTERN_HEIGHT,
+		})
+
+
+def make_pattern(nodes, colors, seed=0):
+	"""
+	Build SVG image pattern.
+	:param nodes: total number of shapes
+	:param colors: number of customizable color tags, every shape is painted with one of them
+	:return: document bytes
+	"""
+	rng = random.Random(seed)
+	palette = ["#%06x" % rng.randrange(1 << 24) for _ in range(colors)]
+	lines = [
+		'<svg height="%d" width="%d" xmlns="http://www.w3.org/2000/svg">' % (PATTERN_HEIGHT, PATTERN_WIDTH),
+		'  <path id="background" d="m0 0v%dh%dv-%dz" fill="#202020"/>' % (PATTERN_HEIGHT, PATTERN_WIDTH, PATTERN_HEIGHT),
+		'  <g id="transform" transform="translate(0,0) scale(1.00)">',
+	]
+	for i in range(nodes):
+		x, y = rng.uniform(0, PATTERN_WIDTH), rng.uniform(0, PATTERN_HEIGHT)
+		w, h = rng.uniform(10, 200), rng.uniform(10, 200)
+		id_ = ' id="color%d"' % (i + 1) if i < colors else ""
+		lines.append('    <path%s d="m%.3f %.3fh%.3fv%.3fh-%.3fz" fill="%s"/>' % (
+			id_, x, y, w, h, w, palette[i % colors]
+		))
+	lines += ['  </g>', '</svg>', '']
+	return "\n".join(lines).encode()
+
+
+def measure(function, repeat, setup=None):
+	"""Run function several times, return list of durations in seconds"""
+	durations = []
+	for _ in range(repeat):
+		if setup is not None:
+			setup()
+		start = time.perf_counter()
+		function()
+		durations.append(time.perf_counter() - start)
+	return durations
+
+
+class Benchmark:
+	"""Benchmark runner"""
+	def __init__(self, args):
+		self.args = args
+		self.results = []
+		self.directory = tempfile.mkdtemp(prefix="aniwall-benchmark-")
+		self.app = BenchmarkApp(os.path.join(self.directory, "export"))
+		os.makedirs(self.app.settings.get_string("export-path"))
+
+		self.parser = ImageParser(self.app, None, ImageIndex(os.path.join(self.directory, "index.json")))
+
+	def close(self):
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+	def add_result(self, name, durations, **params):
+		"""Save measurement and print short report"""
+		result = dict(
+			name=name, params=params, repeat=len(durations),
+			min=min(durations), median=statistics.median(durations), mean=statistics.mean(durations),
+		)
+		self.results.append(result)
+		description = " ".join("%s=%s" % item for item in sorted(params.items()))
+		print("%-12s %-40s median %10.3f ms  min %10.3f ms" % (
+			name, description, result["median"] * 1000, result["min"] * 1000
+		), file=sys.stderr)
+
+	def write_patterns(self, nodes, colors, count):
+		"""Write set of patterns to separate directory, return list of files"""
+		directory = os.path.join(self.directory, "patterns-%d-%d" % (nodes, colors))
+		os.makedirs(directory, exist_ok=True)
+		files = []
+		for i in range(count):
+			file_ = os.path.join(directory, "pattern%04d.svg" % i)
+			with open(file_, "wb") as pattern_file:
+				pattern_file.write(make_pattern(nodes, colors, seed=i))
+			files.append(file_)
+		return directory, files
+
+	def run_scan(self, directory, **params):
+		"""Image search with cold and warm index"""
+		def reset_index():
+			self.parser.index = ImageIndex(os.path.join(self.directory, "index-cold.json"))
+			self.parser.index.records = {}
+
+		self.add_result(
+			"scan-cold", measure(lambda: self.parser.load_images(directory), self.args.repeat, reset_index),
+			**params
+		)
+		self.parser.load_images(directory)
+		self.add_result("scan-warm", measure(lambda: self.parser.load_images(directory), self.args.repeat), **params)
+
+	def run_parse(self, file_, **params):
+		"""Image data loading"""
+		self.add_result(
+			"parse", measure(lambda: self.parser._load_image_data(file_, file_), self.args.repeat), **params
+		)
+
+	def run_rebuild(self, file_, **params):
+		"""Image save with changed colors"""
+		imagedata = self.parser._load_image_data(file_, file_)
+		colors = iter(range(1 << 30))
+
+		def change_colors():
+			value = next(colors)
+			for i in range(len(imagedata.colors) + 1):  # background goes first
+				imagedata.change_color("#%06x" % ((value + i) & 0xffffff), i)
+
+		def rebuild(sync):
+			with WriteBatch(sync) as batch:
+				imagedata.rebuild(batch=batch)
+
+		self.add_result("rebuild", measure(lambda: rebuild(False), self.args.repeat, change_colors), **params)
+		self.add_result("rebuild-sync", measure(lambda: rebuild(True), self.args.repeat, change_colors), **params)
+
+	def run_preview(self, file_, **params):
+		"""Preview rasterization"""
+		self.parser.set_image(file_)
+		data = self.parser.preview
+		for width, height in self.args.preview_size:
+			self.add_result(
+				"preview", measure(lambda: pixbuf_from_svg(data, width, height), self.args.repeat),
+				size="%dx%d" % (width, height), **params
+			)
+
+	def run_export(self, file_, **params):
+		"""Image export with application settings"""
+		self.parser.set_image(file_)
+		for width, height in self.args.export_size:
+			for type_ in self.args.format:
+				self.app.settings.values.update({"export-type": type_, "export-width": width, "export-height": height})
+				self.add_result(
+					"export", measure(self.parser.export_image, self.args.repeat),
+					size="%dx%d" % (width, height), format=type_, **params
+				)
+
+	def run(self):
+		"""Run all benchmarks"""
+		for nodes in self.args.nodes:
+			for colors in self.args.colors:
+				params = dict(nodes=nodes, colors=colors)
+				directory, files = self.write_patterns(nodes, colors, self.args.patterns)
+				self.run_scan(directory, patterns=len(files), **params)
+				self.run_parse(files[0], **params)
+				self.run_rebuild(files[0], **params)
+				self.run_preview(files[0], **params)
+				self.run_export(files[0], **params)
+
+		return dict(meta=self.meta(), results=self.results)
+
+	def meta(self):
+		"""Benchmark environment description"""
+		try:
+			commit = subprocess.check_output(
+				["git", "rev-parse", "HEAD"], cwd=LOCAL_DIR, stderr=subprocess.DEVNULL
+			).decode().strip()
+		except Exception:
+			commit = None
+		return dict(
+			commit=commit, date=time.strftime("%Y-%m-%dT%H:%M:%S"), python=platform.python_version(),
+			platform=platform.platform(), cpu_count=os.cpu_count(), args=vars(self.args),
+		)
+
+
+def _result_key(result):
+	return result["name"], tuple(sorted(result["params"].items()))
+
+
+def compare(old, new):
+	"""Print median time change for every measurement found in both results"""
+	previous = {_result_key(result): result for result in old["results"]}
+	print("Compared with commit %s" % old["meta"].get("commit"), file=sys.stderr)
+	for result in new["results"]:
+		reference = previous.get(_result_key(result))
+		if reference is None:
+			continue
+		description = " ".join("%s=%s" % item for item in sorted(result["params"].items()))
+		change = (result["median"] / reference["median"] - 1) * 100 if reference["median"] else 0
+		print("%-12s %-40s %+8.1f %%" % (result["name"], description, change), file=sys.stderr)
+
+
+def _int_list(value):
+	"""Read comma separated list of numbers"""
+	return [int(item) for item in value.split(",")]
+
+
+def _build_argument_parser():
+	"""Command line arguments description"""
+	parser = argparse.ArgumentParser(description="Measure aniwall scan, parse, rebuild, preview and export speed.")
+	parser.add_argument(
+		"--nodes", type=_int_list, default=[100, 1000, 10000], help="comma separated list of pattern shape counts"
+	)
+	parser.add_argument("--colors", type=_int_list, default=[4, 32], help="comma separated list of color tag counts")
+	parser.add_argument("--patterns", type=int, default=50, help="number of patterns for image search benchmark")
+	parser.add_argument("--repeat", type=int, default=5, help="number of runs for every measurement")
+	parser.add_argument(
+		"--preview-size", type=_size, action="append", help="preview size as WIDTHxHEIGHT, can be repeated"
+	)
+	parser.add_argument(
+		"--export-size", type=_size, action="append", help="export size as WIDTHxHEIGHT, can be repeated"
+	)
+	parser.add_argument("--format", action="append", help="export image type, can be repeated")
+	parser.add_argument("-o", "--output", help="file to save results, printed to stdout by default")
+	parser.add_argument("--compare", metavar="FILE", help="previous results to compare with")
+	return parser
+
+
+def main():
+	args = _build_argument_parser().parse_args()
+	args.preview_size = args.preview_size or [(640, 360), (1280, 720)]
+	args.export_size = args.export_size or [(1920, 1080), (3840, 2160)]
+	args.format = args.format or ["png", "jpeg", "tiff"]
+
+	benchmark = Benchmark(args)
+	try:
+		results = benchmark.run()
+	finally:
+		benchmark.close()
+
+	if args.output:
+		with open(args.output, "w") as output:
+			json.dump(results, output, indent=2)
+	else:
+		print(json.dumps(results, indent=2))
+
+	if args.compare:
+		with open(args.compare) as previous:
+			compare(json.load(previous), results)
+
+
+if __name__ == "__main__":
+	main()